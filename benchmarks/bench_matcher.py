@@ -0,0 +1,104 @@
+"""
+Compare per-pattern fnmatch filtering with the compiled PathMatcher.
+
+Generates a synthetic list of project paths (a million by default) with
+nested directories, vendored folders and a mix of extensions, then filters
+it with both and reports paths per second. Both must keep the same paths.
+
+Usage: python benchmarks/bench_matcher.py [--paths N] [--seed N]
+"""
+import os
+import sys
+import time
+import random
+import fnmatch
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flattener import ALWAYS_IGNORED, PathMatcher  # noqa: E402
+
+SETTINGS = {
+    "allowed_extensions": {
+        ".py": "python", ".js": "javascript", ".ts": "typescript", ".md": "markdown",
+        ".json": "json", ".html": "html", ".css": "css", ".go": "go", ".rs": "rust",
+        ".java": "java", ".c": "c", ".h": "c", ".sql": "sql", ".sh": "bash",
+    },
+    "ignored_files": [
+        "node_modules", ".git", "__pycache__", ".venv", "venv", "dist", "build",
+        "target", ".idea", ".vscode", ".pytest_cache", "coverage", "vendor",
+        "package-lock.json", "yarn.lock", "poetry.lock", ".DS_Store", "Thumbs.db",
+        "*.cpp", "*.pyc", "*.min.js", "*.min.css", "*.map", "*.log", "*.tmp",
+        "*.egg-info", "*.bak", "*~", ".env*", "test_*.snap", "*.generated.*",
+    ],
+}
+
+DIR_NAMES = [
+    "src", "lib", "app", "core", "utils", "api", "models", "views", "tests", "docs",
+    "components", "services", "internal", "pkg", "cmd", "static", "scripts", "config",
+    "node_modules", "build", "dist", "__pycache__", "vendor", "foo.egg-info",
+]
+
+FILE_STEMS = ["index", "main", "utils", "helpers", "models", "README", "config",
+              "server", "client", "test_views", "app", "schema", "types", "bundle"]
+
+FILE_SUFFIXES = [".py", ".js", ".ts", ".md", ".json", ".cpp", ".pyc", ".min.js",
+                 ".map", ".go", ".txt", ".png", ".generated.ts", ".log", ".h", ""]
+
+
+def generate_paths(count, seed):
+    """Build `count` '/' separated file paths, clustered into shared directories."""
+    rng = random.Random(seed)
+    directories = [""]
+    for _ in range(max(1, count // 20)):
+        parent = rng.choice(directories)
+        if parent.count("/") >= 6:
+            parent = ""
+        name = rng.choice(DIR_NAMES)
+        directories.append(f"{parent}/{name}" if parent else name)
+
+    paths = []
+    for i in range(count):
+        rel_dir = rng.choice(directories)
+        filename = f"{rng.choice(FILE_STEMS)}{i % 97}{rng.choice(FILE_SUFFIXES)}"
+        paths.append(f"{rel_dir}/{filename}" if rel_dir else filename)
+    return paths
+
+
+def naive_includes(rel_path, settings):
+    """Filter the way a plain walk does: every component against every pattern."""
+    parts = rel_path.split('/')
+    if os.path.splitext(parts[-1])[1] not in settings["allowed_extensions"]:
+        return False
+    return not any(part in ALWAYS_IGNORED
+                   or any(fnmatch.fnmatch(part, pattern) for pattern in settings["ignored_files"])
+                   for part in parts)
+
+
+def run(name, paths, includes):
+    start = time.perf_counter()
+    kept = {path for path in paths if includes(path)}
+    seconds = time.perf_counter() - start
+    print(f"{name:<10}{len(kept):>12}{seconds:>12.2f}{len(paths) / seconds / 1e6:>16.2f}")
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--paths", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+
+    paths = generate_paths(options.paths, options.seed)
+    print(f"Paths: {len(paths)}, ignore rules: {len(SETTINGS['ignored_files'])}")
+    print(f"{'matcher':<10}{'kept':>12}{'seconds':>12}{'Mpaths/s':>16}")
+    naive = run("fnmatch", paths, lambda path: naive_includes(path, SETTINGS))
+    compiled = run("compiled", paths, PathMatcher(SETTINGS).includes)
+    if naive != compiled:
+        for path in sorted(naive ^ compiled)[:10]:
+            print(f"Mismatch: {path} kept only by {'fnmatch' if path in naive else 'compiled'}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
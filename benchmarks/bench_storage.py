@@ -0,0 +1,92 @@
+"""
+Compare raw and compressed blob storage.
+
+Builds a corpus from the source files under a folder (this repository by
+default), stores it in a fresh database once per codec and reports the
+database size, ingest throughput and read latency.
+
+Usage: python benchmarks/bench_storage.py [source_folder] [--copies N] [--reads N]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flattener_db import (CODEC_RAW, CODEC_ZLIB, connect,  # noqa: E402
+                          hash_content, read_blob, store_blobs)
+
+SOURCE_EXTENSIONS = {".py", ".md", ".j2", ".sh", ".ps1", ".cmd", ".sql", ".json"}
+
+
+def load_corpus(source_folder, copies):
+    """Read the source files and derive `copies` distinct variants of each."""
+    texts = []
+    for dirpath, dirnames, filenames in os.walk(source_folder):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in SOURCE_EXTENSIONS:
+                with open(os.path.join(dirpath, filename), 'r', encoding='utf-8', errors='replace') as f:
+                    texts.append(f.read())
+
+    corpus = {}
+    for copy in range(copies):
+        for text in texts:
+            content = f"{text}\n# variant {copy}\n"
+            corpus[hash_content(content)] = content
+    return corpus
+
+
+def run(codec, corpus, reads):
+    """Store the corpus with one codec and measure it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        conn = connect(db_path)
+
+        total_bytes = sum(len(c.encode('utf-8')) for c in corpus.values())
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        store_blobs(conn, corpus, codec)
+        conn.commit()
+        ingest_seconds = time.perf_counter() - start
+
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db_size = os.path.getsize(db_path)
+
+        sample = random.sample(list(corpus), min(reads, len(corpus)))
+        start = time.perf_counter()
+        for content_hash in sample:
+            read_blob(conn, content_hash)
+        read_seconds = time.perf_counter() - start
+        conn.close()
+
+    return {
+        "db_mb": db_size / 1e6,
+        "ingest_mb_s": total_bytes / 1e6 / ingest_seconds,
+        "read_us": read_seconds / len(sample) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("source", nargs="?",
+                        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--copies", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=2000)
+    options = parser.parse_args()
+
+    corpus = load_corpus(options.source, options.copies)
+    total_mb = sum(len(c.encode('utf-8')) for c in corpus.values()) / 1e6
+    print(f"Corpus: {len(corpus)} blobs, {total_mb:.1f} MB")
+    print(f"{'codec':<8}{'db size (MB)':>14}{'ingest (MB/s)':>16}{'read (us)':>12}")
+    for name, codec in (("raw", CODEC_RAW), ("zlib", CODEC_ZLIB)):
+        result = run(codec, corpus, options.reads)
+        print(f"{name:<8}{result['db_mb']:>14.1f}{result['ingest_mb_s']:>16.1f}{result['read_us']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Stress test concurrent snapshots.
+
+Starts many processes that snapshot the same project into one fresh database
+at the same time. Before each snapshot a process rewrites a file of its own,
+so most snapshots see a new tree. Checks that every snapshot succeeded and
+that the new versions got unique, contiguous version numbers.
+
+Usage: python benchmarks/stress_versions.py [--processes N] [--snapshots N] [--files N]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flattener_db import connect  # noqa: E402
+from snapshot import take_snapshot  # noqa: E402
+
+
+def write_file(path, text):
+    """Replace a file atomically so concurrent scans never see it half written."""
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+
+
+def make_project(root, files):
+    """Create a project with `files` python files and settings that include them."""
+    os.makedirs(os.path.join(root, ".dev"))
+    write_file(os.path.join(root, ".dev", "appsettings.json"),
+               '{"allowed_extensions": {".py": "python"}}')
+    for i in range(files):
+        write_file(os.path.join(root, f"module_{i}.py"), f"VALUE = {i}\n" * 20)
+
+
+def worker(job):
+    """Take `count` snapshots of the project, returning (number, unchanged) or the error."""
+    db_path, root, index, count = job
+    conn = connect(db_path)
+    results = []
+    for i in range(count):
+        write_file(os.path.join(root, f"worker_{index}.py"), f"STEP = {i}\n")
+        try:
+            result = take_snapshot(root, workers=2, conn=conn)
+            results.append((result["version_number"], result["unchanged"]))
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=16)
+    parser.add_argument("--snapshots", type=int, default=5,
+                        help="Snapshots taken by each process")
+    parser.add_argument("--files", type=int, default=50, help="Files in the project")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "stress.db")
+        root = os.path.join(tmp, "stress")
+        make_project(root, options.files)
+        connect(db_path).close()
+
+        jobs = [(db_path, root, i, options.snapshots) for i in range(options.processes)]
+        start = time.perf_counter()
+        with Pool(options.processes) as pool:
+            results = [r for result in pool.map(worker, jobs) for r in result]
+        elapsed = time.perf_counter() - start
+
+    errors = [r for r in results if isinstance(r, str)]
+    created = sorted(number for number, unchanged in
+                     (r for r in results if not isinstance(r, str)) if not unchanged)
+    print(f"{len(results)} snapshots by {options.processes} processes in {elapsed:.2f}s: "
+          f"{len(created)} new versions, {len(results) - len(created) - len(errors)} unchanged")
+    if errors:
+        print(f"FAILED: {len(errors)} snapshots raised, e.g. {errors[0]}")
+        sys.exit(1)
+    if created != list(range(1, len(created) + 1)):
+        print("FAILED: new version numbers are not unique and contiguous")
+        sys.exit(1)
+    print("OK: every snapshot succeeded with a unique version number")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,876 @@
+import os
+import re
+import sys
+import json
+import mmap
+import hashlib
+import fnmatch
+import logging
+import sqlite3
+import argparse
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+from flattener_db import (DB_PATH, DEFAULT_ENCODING, READ_BLOB_SQL, UTF16_BOMS,
+                          codec_from_settings, decode_text, get_connection, hash_content,
+                          iter_blob_chunks, store_blobs, store_external_blobs,
+                          write_external_blob)
+
+# Configure base directories
+DATABASE_DIR = os.path.join(os.path.expanduser("~"), ".fltn_data")
+LOGS_DIR = os.path.join(DATABASE_DIR, "logs")
+
+logger = logging.getLogger("Flattener")
+
+# Folders that are never part of a flattened codebase
+ALWAYS_IGNORED = {".dev"}
+
+# Characters that make an ignored_files entry a glob pattern
+GLOB_CHARS = frozenset("*?[")
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Number of changed files buffered before the stat cache is written
+CACHE_FLUSH_SIZE = 500
+
+# Bytes read from the start of a file to decide whether it is worth reading
+SNIFF_BYTES = 8192
+
+# Defaults for the "max_file_size" and "max_line_length" settings; 0 turns a check off
+DEFAULT_MAX_FILE_SIZE = 10 * 1024 * 1024
+DEFAULT_MAX_LINE_LENGTH = 1000
+
+# Default for the "external_blob_size" setting: larger files are memory-mapped
+# and stored as files under ~/.fltn_data/blobs instead of in the database
+DEFAULT_EXTERNAL_BLOB_SIZE = 1024 * 1024
+
+# Values of the "output_format" setting
+OUTPUT_MARKDOWN = "markdown"
+OUTPUT_FRAMED = "framed"
+OUTPUT_FORMATS = (OUTPUT_MARKDOWN, OUTPUT_FRAMED)
+
+# Framed output: the markdown layout, but each opening fence ends with the
+# byte length of the contents ("```python length=000000000042"), and the
+# document ends with a JSON-lines index of (path, offset, length, hash) and
+# a fixed-size trailer holding the index offset
+FRAMED_MAGIC = b"<!-- fltn-framed 1 -->\n"
+FRAMED_LENGTH_WIDTH = 12
+FRAMED_INDEX_START = b"<!-- fltn-index\n"
+FRAMED_INDEX_END = b"-->\n"
+FRAMED_TRAILER = "<!-- fltn-index-offset {:012d} -->\n"
+FRAMED_TRAILER_SIZE = len(FRAMED_TRAILER.format(0))
+
+# Reasons a file is skipped, as reported by scan_project and flatten_project
+SKIP_TOO_LARGE = "too large"
+SKIP_BINARY = "binary"
+SKIP_MINIFIED = "minified"
+SKIP_UNREADABLE = "unreadable"
+SKIP_UNDECODABLE_NAME = "undecodable name"
+
+STAT_CACHE_SQL = '''
+SELECT path, size, mtime_ns, inode, content_hash, encoding FROM file_stats WHERE project_id = ?
+'''
+
+UPSERT_STAT_SQL = '''
+INSERT INTO file_stats (project_id, path, size, mtime_ns, inode, content_hash, encoding)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (project_id, path) DO UPDATE SET
+    size = excluded.size,
+    mtime_ns = excluded.mtime_ns,
+    inode = excluded.inode,
+    content_hash = excluded.content_hash,
+    encoding = excluded.encoding
+'''
+
+
+def configure_logging() -> None:
+    """Send log output to the central logs folder and the console."""
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    log_file = os.path.join(
+        LOGS_DIR, f"flattener_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
+
+
+def load_settings(settings_path: str) -> Dict:
+    """
+    Load the flattening rules from an appsettings.json file.
+
+    Args:
+        settings_path: Path to appsettings.json
+
+    Returns:
+        Dictionary with at least 'allowed_extensions' and 'ignored_files'
+    """
+    try:
+        with open(settings_path, 'r') as f:
+            settings = json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to load {settings_path}: {e}")
+        settings = {}
+
+    settings.setdefault("allowed_extensions", {})
+    settings.setdefault("ignored_files", [])
+    return settings
+
+
+class PathMatcher:
+    """
+    The ignored_files and allowed_extensions rules, compiled once.
+
+    Plain names go into a set, '*.ext' patterns into a set of extensions and
+    every other glob into one combined regex, so checking a name costs a few
+    lookups instead of one fnmatch call per pattern. Gives the same answers
+    as fnmatch, including its case folding on Windows.
+    """
+
+    def __init__(self, settings: Dict):
+        self.allowed_extensions = settings["allowed_extensions"]
+        self.fold_case = os.path.normcase("A") != "A"
+        self.names = set()
+        self.extensions = set()
+        globs = []
+        for pattern in [*ALWAYS_IGNORED, *settings["ignored_files"]]:
+            pattern = os.path.normcase(pattern) if self.fold_case else pattern
+            if not GLOB_CHARS.intersection(pattern):
+                self.names.add(pattern)
+            elif (pattern.startswith("*.") and "." not in pattern[2:]
+                  and not GLOB_CHARS.intersection(pattern[1:])):
+                self.extensions.add(pattern[1:])
+            else:
+                globs.append(fnmatch.translate(pattern))
+        self.glob = re.compile("|".join(globs)).match if globs else None
+        # Ignore decisions per '/' separated directory, for includes()
+        self.ignored_dirs: Dict[str, bool] = {"": False}
+
+    def ignores(self, name: str) -> bool:
+        """
+        Check a file or directory name against the ignored_files rules.
+
+        Args:
+            name: Base name of the file or directory
+
+        Returns:
+            True if the entry should be skipped; for a directory, that it
+            should not be descended into
+        """
+        if self.fold_case:
+            name = os.path.normcase(name)
+        if name in self.names:
+            return True
+        dot = name.rfind(".")
+        if dot >= 0 and name[dot:] in self.extensions:
+            return True
+        return self.glob is not None and self.glob(name) is not None
+
+    def allows(self, filename: str) -> bool:
+        """Check a file name against the allowed_extensions rules."""
+        return os.path.splitext(filename)[1] in self.allowed_extensions
+
+    def _ignores_dir(self, rel_dir: str) -> bool:
+        """Check whether a directory or any directory above it is ignored."""
+        ignored = self.ignored_dirs.get(rel_dir)
+        if ignored is None:
+            parent, _, name = rel_dir.rpartition('/')
+            ignored = self.ignores(name) or self._ignores_dir(parent)
+            self.ignored_dirs[rel_dir] = ignored
+        return ignored
+
+    def includes(self, rel_path: str) -> bool:
+        """
+        Check a '/' separated path against the flattening rules.
+
+        Used where paths come from somewhere other than a directory walk, e.g.
+        a git tree: every directory on the way must pass the ignore rules too.
+        Directory decisions are remembered, so each directory is checked once.
+
+        Args:
+            rel_path: Path of the file relative to the project root
+
+        Returns:
+            True if the file would be flattened
+        """
+        rel_dir, _, filename = rel_path.rpartition('/')
+        return (self.allows(filename) and not self.ignores(filename)
+                and not self._ignores_dir(rel_dir))
+
+
+def git_project_files(root_folder: str, settings: Dict) -> Optional[List[Tuple[str, str]]]:
+    """
+    Collect the files to flatten from `git ls-files`.
+
+    One git call lists tracked files and untracked files that are not
+    ignored, so .gitignore rules are honoured and ignored directories such
+    as build output are never walked.
+
+    Args:
+        root_folder: Root directory of the project, a git work tree
+        settings: Flattening rules from appsettings.json
+
+    Returns:
+        Sorted list of (rel_dir, filename) tuples, using '/' separators, or
+        None if git is not available or the folder is not a work tree
+    """
+    try:
+        output = subprocess.run(
+            ["git", "-C", root_folder, "ls-files", "-z", "--cached", "--others",
+             "--exclude-standard"],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"git ls-files failed in {root_folder}, walking the folder instead: {e}")
+        return None
+
+    matcher = PathMatcher(settings)
+    files = set()
+    for path in output.decode('utf-8', errors='surrogateescape').split('\0'):
+        if path and matcher.includes(path):
+            rel_dir, _, filename = path.rpartition('/')
+            files.add((rel_dir, filename))
+    return sorted(files)
+
+
+def walk_project_files(root_folder: str, settings: Dict) -> List[Tuple[str, str]]:
+    """
+    Walk a project with os.scandir and collect the files to flatten.
+
+    Args:
+        root_folder: Root directory of the project
+        settings: Flattening rules from appsettings.json
+
+    Returns:
+        Sorted list of (rel_dir, filename) tuples, using '/' separators
+    """
+    matcher = PathMatcher(settings)
+
+    files = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = os.path.join(root_folder, rel_dir) if rel_dir else root_folder
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    # Ignored directories are pruned here, before they are read
+                    if matcher.ignores(entry.name):
+                        continue
+                    rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(rel_path)
+                        elif entry.is_file() and matcher.allows(entry.name):
+                            files.append((rel_dir, entry.name))
+                    except OSError as e:
+                        logger.warning(f"Skipping {rel_path}: {e}")
+        except OSError as e:
+            logger.warning(f"Cannot read directory {abs_dir}: {e}")
+
+    # Sort by (directory, name) so the output order matches the database order
+    files.sort()
+    return files
+
+
+def collect_project_files(root_folder: str, settings: Dict) -> List[Tuple[str, str]]:
+    """
+    Collect the files to flatten.
+
+    In a git work tree the list comes from `git ls-files` unless the
+    "use_git" setting is false; otherwise the folder is walked.
+
+    Args:
+        root_folder: Root directory of the project
+        settings: Flattening rules from appsettings.json
+
+    Returns:
+        Sorted list of (rel_dir, filename) tuples, using '/' separators
+    """
+    if settings.get("use_git", True) and os.path.exists(os.path.join(root_folder, ".git")):
+        files = git_project_files(root_folder, settings)
+        if files is not None:
+            return files
+    return walk_project_files(root_folder, settings)
+
+
+def format_entry(rel_path: str, language: str, content: str) -> str:
+    """
+    Format a single file as a section of the flattened markdown document.
+
+    Args:
+        rel_path: Path of the file relative to the project root
+        language: Markdown language identifier for the code fence
+        content: File contents
+
+    Returns:
+        The markdown section for the file
+    """
+    return f"# {rel_path}\n```{language}\n{content}\n```\n\n"
+
+
+class FramedWriter:
+    """
+    Writes the framed output format to a binary stream.
+
+    The document stays readable markdown, but a reader never has to scan
+    for fences: every section states the byte length of its contents, and
+    the index at the end gives the offset of each file, so any file can be
+    read with one seek and '# ' lines or fences inside files cannot
+    confuse the parser.
+
+    Offsets are positions in the stream. A seekable stream may already hold
+    data; a stream that cannot seek is assumed to start at offset 0, so the
+    document must be the start of whatever file it ends up in.
+    """
+
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.seekable = out.seekable()
+        self.position = out.tell() if self.seekable else 0
+        self.index: List[Dict] = []
+        self._write(FRAMED_MAGIC)
+
+    def _write(self, data: bytes) -> None:
+        self.out.write(data)
+        self.position += len(data)
+
+    def write_entry(self, rel_path: str, language: str, chunks: Iterable[str]) -> None:
+        """
+        Write one file's section.
+
+        On a seekable stream the contents are streamed and the length field
+        is filled in afterwards; otherwise the file is gathered first.
+        """
+        self._write(f"# {rel_path}\n```{language} length=".encode('utf-8'))
+        hasher = hashlib.sha1()
+        if self.seekable:
+            length_position = self.out.tell()
+            self._write(b"0" * FRAMED_LENGTH_WIDTH + b"\n")
+            offset = self.position
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                hasher.update(data)
+                self._write(data)
+            length = self.position - offset
+            end = self.out.tell()
+            self.out.seek(length_position)
+            self.out.write(f"{length:0{FRAMED_LENGTH_WIDTH}d}".encode('ascii'))
+            self.out.seek(end)
+        else:
+            data = b"".join(chunk.encode('utf-8') for chunk in chunks)
+            hasher.update(data)
+            length = len(data)
+            self._write(f"{length:0{FRAMED_LENGTH_WIDTH}d}\n".encode('ascii'))
+            offset = self.position
+            self._write(data)
+        self._write(b"\n```\n\n")
+        self.index.append({"path": rel_path, "language": language, "offset": offset,
+                           "length": length, "hash": hasher.hexdigest()})
+
+    def close(self) -> None:
+        """Write the index and trailer; the stream itself is left open."""
+        index_offset = self.position
+        self._write(FRAMED_INDEX_START)
+        for entry in self.index:
+            self._write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n")
+        self._write(FRAMED_INDEX_END)
+        self._write(FRAMED_TRAILER.format(index_offset).encode('ascii'))
+
+
+def write_output(out: BinaryIO, sections: Iterable[Tuple[str, str, Iterable[str]]],
+                 output_format: str = OUTPUT_MARKDOWN) -> Dict:
+    """
+    Write a flattened document as UTF-8.
+
+    Args:
+        out: Binary stream to write to
+        sections: (rel_path, language, pieces of the contents) per file,
+            in output order
+        output_format: OUTPUT_MARKDOWN or OUTPUT_FRAMED
+
+    Returns:
+        Dictionary with the number of files and bytes written
+    """
+    files = 0
+    if output_format == OUTPUT_FRAMED:
+        writer = FramedWriter(out)
+        for rel_path, language, chunks in sections:
+            writer.write_entry(rel_path, language, chunks)
+            files += 1
+        writer.close()
+        return {"files": files, "bytes": writer.position}
+
+    written = 0
+    for rel_path, language, chunks in sections:
+        # Same text as format_entry, with the contents streamed in between
+        head, tail = (part.encode('utf-8')
+                      for part in format_entry(rel_path, language, "\0").split("\0"))
+        out.write(head)
+        written += len(head) + len(tail)
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            out.write(data)
+            written += len(data)
+        out.write(tail)
+        files += 1
+    return {"files": files, "bytes": written}
+
+
+def load_stat_cache(conn: sqlite3.Connection,
+                    project_id: int) -> Dict[str, Tuple[int, int, int, str, Optional[str]]]:
+    """
+    Load the stat signatures of every cached file of a project.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+
+    Returns:
+        Dictionary mapping relative path to (size, mtime_ns, inode,
+        content_hash, encoding)
+    """
+    cursor = conn.execute(STAT_CACHE_SQL, (project_id,))
+    return {row[0]: tuple(row[1:]) for row in cursor}
+
+
+def output_format_from_settings(settings: Dict) -> str:
+    """
+    Get the layout of flattened outputs from the "output_format" setting.
+
+    Args:
+        settings: Flattening rules from appsettings.json
+
+    Returns:
+        OUTPUT_MARKDOWN or OUTPUT_FRAMED, OUTPUT_MARKDOWN if the setting is
+        missing or unknown
+    """
+    name = str(settings.get("output_format", OUTPUT_MARKDOWN)).lower()
+    if name not in OUTPUT_FORMATS:
+        logger.warning(f"Unknown output_format '{name}', writing markdown")
+        return OUTPUT_MARKDOWN
+    return name
+
+
+def read_limits(settings: Dict) -> Dict[str, int]:
+    """
+    Get the limits that decide whether and how files are read.
+
+    Example: {"max_file_size": 2000000, "max_line_length": 500,
+              "external_blob_size": 262144}
+
+    Args:
+        settings: Flattening rules from appsettings.json
+
+    Returns:
+        Dictionary with max_file_size and external_blob_size in bytes and
+        max_line_length in characters; 0 means no limit
+    """
+    return {"max_file_size": int(settings.get("max_file_size", DEFAULT_MAX_FILE_SIZE)),
+            "max_line_length": int(settings.get("max_line_length", DEFAULT_MAX_LINE_LENGTH)),
+            "external_blob_size": int(settings.get("external_blob_size",
+                                                   DEFAULT_EXTERNAL_BLOB_SIZE))}
+
+
+def undecodable_path(path: str) -> Optional[str]:
+    """
+    Check that a path can be stored, i.e. that it is valid UTF-8.
+
+    File names that are not valid UTF-8 come back from the OS and git with
+    their bytes escaped as lone surrogates, which the database, the log and
+    the flattened output cannot encode.
+
+    Args:
+        path: Relative path as listed by os.scandir or git
+
+    Returns:
+        A printable form of the path if it is not valid UTF-8, else None
+    """
+    try:
+        path.encode('utf-8')
+    except UnicodeEncodeError:
+        return path.encode('utf-8', errors='backslashreplace').decode('utf-8')
+    return None
+
+
+def sniff(head: bytes, limits: Dict[str, int]) -> Optional[str]:
+    """
+    Decide from the start of a file whether it is source code.
+
+    A NUL byte means a binary file, unless the file starts with a UTF-16
+    byte order mark. Minified bundles and similar generated files are
+    recognised by their average line length.
+
+    Args:
+        head: Up to SNIFF_BYTES from the start of the file
+        limits: Limits from read_limits
+
+    Returns:
+        The reason to skip the file, or None if it should be read
+    """
+    if b"\0" in head and not head.startswith(tuple(bom for bom, _ in UTF16_BOMS)):
+        return SKIP_BINARY
+    max_line_length = limits["max_line_length"]
+    if max_line_length and len(head) / (head.count(b"\n") + 1) > max_line_length:
+        return SKIP_MINIFIED
+    return None
+
+
+def _read_large_file(abs_path: str, record: Dict, limits: Dict[str, int]) -> Dict:
+    """
+    Read a file over the external_blob_size limit through a memory map.
+
+    The mapped file is sniffed, then hashed and copied into the external
+    blob store in one pass, so its contents never become a Python string.
+    Files that are not valid UTF-8 are decoded with decode_text and stored
+    the usual way.
+    """
+    with open(abs_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        reason = sniff(mapped[:SNIFF_BYTES], limits)
+        if reason is not None:
+            record['skipped'] = reason
+            return record
+        stored = write_external_blob(mapped)
+        if stored is None:
+            record['content'], record['encoding'] = decode_text(mapped[:])
+            record['hash'] = hash_content(record['content'])
+            return record
+    record['content'] = None
+    record['encoding'] = DEFAULT_ENCODING
+    record['hash'], record['external'] = stored
+    return record
+
+
+def _read_file(root_folder: str, rel_dir: str, filename: str,
+               allowed_extensions: Dict[str, str],
+               cached: Optional[Tuple[int, int, int, str, Optional[str]]] = None,
+               limits: Optional[Dict[str, int]] = None) -> Optional[Dict]:
+    """
+    Stat one file and read it unless the stat cache says it is unchanged.
+
+    Files whose path is not valid UTF-8 are skipped without being opened.
+    Files over the size limit are skipped on their stat alone; others are
+    sniffed from their first SNIFF_BYTES before the rest is read. A skipped
+    file's record has a 'skipped' reason instead of 'content' and 'hash'.
+    Returns None if the file no longer exists. For a cache hit the returned
+    'content' is None, and the content is already stored under 'hash'.
+    'encoding' is the encoding the contents were decoded from.
+    Files over the external_blob_size limit are copied to the external blob
+    store; their 'content' is None and 'external' holds the blob name.
+    """
+    rel_path = f"{rel_dir}/{filename}" if rel_dir else filename
+    abs_path = os.path.join(root_folder, rel_path)
+    language = allowed_extensions.get(os.path.splitext(filename)[1], "")
+    record = {'rel_dir': rel_dir, 'filename': filename, 'rel_path': rel_path,
+              'language': language}
+    printable = undecodable_path(rel_path)
+    if printable is not None:
+        record['rel_path'] = printable
+        record['skipped'] = SKIP_UNDECODABLE_NAME
+        return record
+    limits = limits or read_limits({})
+    try:
+        st = os.stat(abs_path)
+    except FileNotFoundError:
+        # Listed by git but deleted from the work tree
+        return None
+    except OSError as e:
+        logger.warning(f"Failed to read {rel_path}: {e}")
+        record['skipped'] = SKIP_UNREADABLE
+        return record
+
+    if limits["max_file_size"] and st.st_size > limits["max_file_size"]:
+        record['skipped'] = SKIP_TOO_LARGE
+        return record
+
+    record['stat'] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    # Rows cached before encodings were recorded are read once more, since
+    # their contents may have been decoded lossily
+    if cached is not None and cached[:3] == record['stat'] and cached[4] is not None:
+        record['content'] = None
+        record['hash'] = cached[3]
+        record['encoding'] = cached[4]
+        return record
+
+    try:
+        if limits["external_blob_size"] and st.st_size > limits["external_blob_size"]:
+            return _read_large_file(abs_path, record, limits)
+        with open(abs_path, 'rb') as f:
+            data = f.read(SNIFF_BYTES)
+            reason = sniff(data, limits)
+            if reason is not None:
+                record['skipped'] = reason
+                return record
+            data += f.read()
+    except OSError as e:
+        logger.warning(f"Failed to read {rel_path}: {e}")
+        record['skipped'] = SKIP_UNREADABLE
+        return record
+
+    record['content'], record['encoding'] = decode_text(data)
+    record['hash'] = hash_content(record['content'])
+    return record
+
+
+def _iter_read_files(root_folder: str, files: List[Tuple[str, str]],
+                     allowed_extensions: Dict[str, str], workers: int,
+                     cache: Optional[Dict] = None,
+                     limits: Optional[Dict[str, int]] = None,
+                     skipped: Optional[List[Tuple[str, str]]] = None) -> Iterator[Dict]:
+    """
+    Read files on a thread pool, yielding records in the order of `files`.
+
+    Only a bounded window of files is in flight, so memory stays flat.
+    Skipped files are not yielded; their (rel_path, reason) pairs are
+    appended to `skipped` if it is given.
+    """
+    cache = cache or {}
+
+    def result(future):
+        record = future.result()
+        if record is not None and 'skipped' in record:
+            if skipped is not None:
+                skipped.append((record['rel_path'], record['skipped']))
+            return None
+        return record
+
+    window = max(1, workers) * 4
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for rel_dir, filename in files:
+            rel_path = f"{rel_dir}/{filename}" if rel_dir else filename
+            pending.append(executor.submit(
+                _read_file, root_folder, rel_dir, filename,
+                allowed_extensions, cache.get(rel_path), limits))
+            if len(pending) >= window:
+                record = result(pending.popleft())
+                if record is not None:
+                    yield record
+        while pending:
+            record = result(pending.popleft())
+            if record is not None:
+                yield record
+
+
+def log_skipped(skipped: List[Tuple[str, str]]) -> None:
+    """Report the files a run left out and why."""
+    for rel_path, reason in skipped:
+        logger.info(f"Skipped {rel_path}: {reason}")
+
+
+def scan_project(conn: sqlite3.Connection, project_id: int, root_folder: str,
+                 settings: Dict, workers: int = DEFAULT_WORKERS,
+                 exclude: Optional[str] = None) -> Tuple[List[Dict], Dict]:
+    """
+    Bring the stored contents and stat cache of a project up to date.
+
+    Files whose size, mtime and inode match the project's stat cache are not
+    read again. Changed files are read on a thread pool and their contents
+    stored in the blobs table, so afterwards every file is available by hash.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        root_folder: Root directory of the project
+        settings: Flattening rules from appsettings.json
+        workers: Number of reader threads
+        exclude: Absolute path of a file to leave out, e.g. the output file
+
+    Returns:
+        Tuple of the sorted file records (rel_dir, filename, rel_path,
+        language, encoding, hash) and a dictionary with scan statistics, including
+        the (rel_path, reason) pairs of skipped files
+    """
+    root_folder = os.path.abspath(root_folder)
+    codec = codec_from_settings(settings)
+    files = collect_project_files(root_folder, settings)
+    if exclude is not None:
+        files = [(d, f) for d, f in files
+                 if os.path.join(root_folder, d, f) != os.path.abspath(exclude)]
+    cache = load_stat_cache(conn, project_id)
+
+    records = []
+    skipped = []
+    cache_hits = 0
+    cache_updates = []
+    new_blobs = {}
+    external_blobs = {}
+
+    def flush(deleted_paths=()):
+        # Contents go to the blobs table first, then the stat rows; commit
+        # per batch so concurrent runs are not locked out for the whole scan.
+        # The write lock is taken up front, so the lookups in store_blobs
+        # never have to upgrade a read transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            store_blobs(conn, new_blobs, codec)
+            store_external_blobs(conn, external_blobs)
+            conn.executemany(UPSERT_STAT_SQL, cache_updates)
+            conn.executemany("DELETE FROM file_stats WHERE project_id = ? AND path = ?",
+                             [(project_id, path) for path in deleted_paths])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        new_blobs.clear()
+        external_blobs.clear()
+        cache_updates.clear()
+
+    for record in _iter_read_files(root_folder, files, settings["allowed_extensions"],
+                                   workers, cache, read_limits(settings), skipped):
+        external = record.pop('external', None)
+        if record['content'] is None and external is None:
+            cache_hits += 1
+        else:
+            if external is not None:
+                external_blobs[record['hash']] = (external, record['stat'][0])
+            else:
+                new_blobs[record['hash']] = record['content']
+            cache_updates.append((project_id, record['rel_path'], *record['stat'],
+                                  record['hash'], record['encoding']))
+            if len(cache_updates) >= CACHE_FLUSH_SIZE:
+                flush()
+        del record['content'], record['stat']
+        records.append(record)
+
+    # Forget files that no longer exist
+    seen_paths = {record['rel_path'] for record in records}
+    flush([path for path in cache if path not in seen_paths])
+
+    log_skipped(skipped)
+    return records, {"files": len(records), "cache_hits": cache_hits, "skipped": skipped}
+
+
+def write_flattened(conn: sqlite3.Connection, records: List[Dict], output_path: str,
+                    output_format: str = OUTPUT_MARKDOWN) -> int:
+    """
+    Write the flattened document for scanned files from stored contents.
+
+    External blobs are streamed from their files rather than read whole.
+
+    Args:
+        conn: Open database connection
+        records: File records from scan_project
+        output_path: Path of the markdown file to write
+        output_format: OUTPUT_MARKDOWN or OUTPUT_FRAMED
+
+    Returns:
+        Number of bytes written
+    """
+    def sections():
+        for record in records:
+            row = conn.execute(READ_BLOB_SQL, (record['hash'],)).fetchone()
+            if row is None:
+                raise KeyError(f"Blob not found: {record['hash']}")
+            yield record['rel_path'], record['language'], iter_blob_chunks(*row)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)) or ".", exist_ok=True)
+    with open(output_path, 'wb') as out:
+        return write_output(out, sections(), output_format)["bytes"]
+
+
+def flatten_project(root_folder: str, output_path: str, settings: Dict,
+                    workers: int = DEFAULT_WORKERS,
+                    project_id: Optional[int] = None,
+                    db_path: str = DB_PATH) -> Dict:
+    """
+    Flatten a project into a single markdown file, in the layout chosen by
+    the "output_format" setting.
+
+    Files are read and formatted on a thread pool, but written in the
+    sorted order from collect_project_files so the output is deterministic.
+    When a project_id is given, files whose size, mtime and inode match the
+    project's stat cache are taken from the database instead of being re-read.
+
+    Args:
+        root_folder: Root directory of the project
+        output_path: Path of the markdown file to write
+        settings: Flattening rules from appsettings.json
+        workers: Number of reader threads
+        project_id: Database ID of the project, enables the stat cache
+        db_path: Path to the SQLite database holding the stat cache
+
+    Returns:
+        Dictionary with the number of files and bytes written, cache hits
+        and the (rel_path, reason) pairs of skipped files
+    """
+    start = datetime.now()
+    root_folder = os.path.abspath(root_folder)
+    output_abs = os.path.abspath(output_path)
+
+    if project_id is not None:
+        conn = get_connection(db_path)
+        records, stats = scan_project(conn, project_id, root_folder, settings,
+                                      workers, exclude=output_abs)
+        written_bytes = write_flattened(conn, records, output_abs,
+                                        output_format_from_settings(settings))
+        written_files = stats["files"]
+        cache_hits = stats["cache_hits"]
+        skipped = stats["skipped"]
+    else:
+        files = [(d, f) for d, f in collect_project_files(root_folder, settings)
+                 if os.path.join(root_folder, d, f) != output_abs]
+        cache_hits = 0
+        skipped = []
+        # Nothing is stored here, so large files are read like any other
+        limits = dict(read_limits(settings), external_blob_size=0)
+        records = _iter_read_files(root_folder, files, settings["allowed_extensions"],
+                                   workers, limits=limits, skipped=skipped)
+        os.makedirs(os.path.dirname(output_abs) or ".", exist_ok=True)
+        with open(output_abs, 'wb') as out:
+            written = write_output(
+                out, ((r['rel_path'], r['language'], (r['content'],)) for r in records),
+                output_format_from_settings(settings))
+        written_files = written["files"]
+        written_bytes = written["bytes"]
+        log_skipped(skipped)
+
+    elapsed = (datetime.now() - start).total_seconds()
+    logger.info(
+        f"Flattened {written_files} files ({written_bytes} bytes, {cache_hits} from cache, "
+        f"{len(skipped)} skipped) into {output_abs} in {elapsed:.2f}s")
+    return {"files": written_files, "bytes": written_bytes, "cache_hits": cache_hits,
+            "skipped": skipped, "seconds": elapsed}
+
+
+def main(args: List[str]) -> None:
+    """
+    Command line entry point, compatible with the CodeFlattener.exe arguments.
+
+    Args:
+        args: Command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Flatten a codebase into a single markdown file.")
+    parser.add_argument("-i", "--input", default=".",
+                        help="Root folder of the codebase")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Path of the markdown file to write")
+    parser.add_argument("-c", "--config",
+                        help="Path to appsettings.json (defaults to the install folder)")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of reader threads")
+    parser.add_argument("-p", "--project-id", type=int,
+                        help="Database ID of the project, enables the stat cache")
+    options = parser.parse_args(args)
+
+    configure_logging()
+
+    config_path = options.config or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "appsettings.json")
+    settings = load_settings(config_path)
+
+    try:
+        flatten_project(options.input, options.output, settings,
+                        options.workers, options.project_id)
+    except Exception as e:
+        logger.error(f"Failed to flatten {options.input}: {e}", exc_info=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,1028 @@
+import os
+import re
+import zlib
+import atexit
+import codecs
+import hashlib
+import logging
+import sqlite3
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Configure base directories
+DATABASE_DIR = os.path.join(os.path.expanduser("~"), ".fltn_data")
+DB_PATH = os.path.join(DATABASE_DIR, "flattener.db")
+BLOBS_DIR = os.path.join(DATABASE_DIR, "blobs")
+PACKS_DIR = os.path.join(DATABASE_DIR, "packs")
+
+logger = logging.getLogger("Database")
+
+# Bump when adding a migration to MIGRATIONS
+SCHEMA_VERSION = 11
+
+# Codec stored with each blob, describing how its content column is encoded
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+# The contents live in a file under BLOBS_DIR; the column holds its relative path
+CODEC_EXTERNAL = 2
+
+# Names accepted for the "compression" setting in appsettings.json
+CODECS_BY_NAME = {
+    "none": CODEC_RAW,
+    "zlib": CODEC_ZLIB,
+}
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Bytes handled at a time when copying or streaming external blobs
+EXTERNAL_CHUNK_SIZE = 1024 * 1024
+
+# Encoding of file contents read from disk, assumed for rows stored before
+# encodings were recorded
+DEFAULT_ENCODING = "utf-8"
+
+# Encodings tried after UTF-8 for files that are not valid UTF-8; latin-1
+# decodes any bytes, so detection always ends with a result
+UTF16_BOMS = ((codecs.BOM_UTF16_LE, "utf-16-le"), (codecs.BOM_UTF16_BE, "utf-16-be"))
+FALLBACK_ENCODINGS = ("cp1252",)
+LAST_RESORT_ENCODING = "latin-1"
+
+# Maximum number of host parameters used in a single IN (...) lookup
+LOOKUP_CHUNK_SIZE = 500
+
+# Connection settings applied by connect()
+BUSY_TIMEOUT_MS = 30000
+CACHE_SIZE_KB = 65536
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Connections shared by everything in this process, keyed by database path
+_connections: Dict[str, sqlite3.Connection] = {}
+
+# Lookups shared by the writers and readers; `fltn db explain` checks their plans
+PROJECT_BY_PATH_SQL = "SELECT id FROM projects WHERE path = ?"
+
+PROJECT_BY_NAME_SQL = "SELECT id FROM projects WHERE name = ? ORDER BY id"
+
+# Safe against concurrent first runs: the loser of the race keeps the row
+REGISTER_PROJECT_SQL = "INSERT INTO projects (name, path) VALUES (?, ?) ON CONFLICT (path) DO NOTHING"
+
+# Bumps the project's head counter and returns the new version number; the
+# first allocation for a project starts after any versions already stored
+ALLOCATE_VERSION_SQL = '''
+INSERT INTO project_heads (project_id, last_version)
+SELECT :project_id, COALESCE(MAX(version_number), 0) + 1
+FROM versions WHERE project_id = :project_id
+ON CONFLICT (project_id) DO UPDATE SET last_version = last_version + 1
+RETURNING last_version
+'''
+
+HEAD_VERSION_SQL = '''
+SELECT id, version_number, tree_hash FROM versions
+WHERE project_id = ?
+ORDER BY version_number DESC
+LIMIT 1
+'''
+
+VERSION_BY_NUMBER_SQL = "SELECT id, tree_hash FROM versions WHERE project_id = ? AND version_number = ?"
+
+TREE_CHILDREN_SQL = "SELECT path, hash FROM trees WHERE version_id = ? AND parent_path = ?"
+
+DIR_FILES_SQL = "SELECT filename, content_hash FROM files WHERE version_id = ? AND rel_path = ?"
+
+VERSION_DIRS_SQL = "SELECT path FROM trees WHERE version_id = ?"
+
+# Files of a version with their stored contents, in flattened output order
+VERSION_FILES_SQL = '''
+SELECT f.rel_path, f.filename, f.language, b.codec, b.content, f.encoding
+FROM files f
+JOIN blobs b ON b.hash = f.content_hash
+WHERE f.version_id = ?
+ORDER BY f.rel_path, f.filename
+'''
+
+VERSION_ENTRIES_SQL = "SELECT rel_path, filename, content_hash, language FROM files WHERE version_id = ?"
+
+BLOB_LOOKUP_SQL = "SELECT hash FROM blobs WHERE hash IN ({placeholders})"
+
+READ_BLOB_SQL = "SELECT codec, content FROM blobs WHERE hash = ?"
+
+EXTERNAL_LOOKUP_SQL = "SELECT hash, codec FROM blobs WHERE hash IN ({placeholders})"
+
+UPSERT_FILE_SQL = '''
+INSERT INTO files (version_id, rel_path, filename, content_hash, language, encoding)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (version_id, rel_path, filename) DO UPDATE SET
+    content_hash = excluded.content_hash,
+    language = excluded.language,
+    encoding = excluded.encoding
+'''
+
+FILE_HISTORY_SQL = '''
+SELECT v.version_number, v.created_at, f.content_hash, f.language
+FROM files f
+JOIN versions v ON v.id = f.version_id
+WHERE f.rel_path = ? AND f.filename = ? AND v.project_id = ?
+ORDER BY v.version_number
+'''
+
+PROJECTS_TABLE = '''
+CREATE TABLE IF NOT EXISTS projects (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+VERSIONS_TABLE = '''
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id INTEGER NOT NULL,
+    version_number INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (project_id) REFERENCES projects (id),
+    UNIQUE (project_id, version_number)
+)
+'''
+
+BLOBS_TABLE = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    content TEXT NOT NULL
+)
+'''
+
+FILES_TABLE = '''
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    version_id INTEGER NOT NULL,
+    rel_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    language TEXT,
+    FOREIGN KEY (version_id) REFERENCES versions (id),
+    FOREIGN KEY (content_hash) REFERENCES blobs (hash),
+    UNIQUE (version_id, rel_path, filename)
+)
+'''
+
+FILE_STATS_TABLE = '''
+CREATE TABLE IF NOT EXISTS {name} (
+    project_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (project_id, path),
+    FOREIGN KEY (project_id) REFERENCES projects (id),
+    FOREIGN KEY (content_hash) REFERENCES blobs (hash)
+)
+'''
+
+AI_DOCS_TABLE = '''
+CREATE TABLE IF NOT EXISTS ai_docs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id INTEGER NOT NULL,
+    doc_number INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (project_id) REFERENCES projects (id)
+)
+'''
+
+
+def hash_content(content: str) -> str:
+    """
+    Compute the content hash that identifies a blob.
+
+    Args:
+        content: File contents
+
+    Returns:
+        Hex digest of the UTF-8 encoded contents
+    """
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def decode_text(data: bytes) -> Tuple[str, str]:
+    """
+    Decode file contents, detecting their encoding.
+
+    UTF-8 is tried first, which is all most trees need. Otherwise a UTF-16
+    byte order mark is honoured, then FALLBACK_ENCODINGS are tried, and
+    latin-1 takes whatever is left, so decoding never fails. Encoding the
+    text with the returned encoding gives back the original bytes.
+
+    Args:
+        data: Raw file contents
+
+    Returns:
+        Tuple of the text and the name of the encoding it was decoded from
+    """
+    try:
+        return data.decode(DEFAULT_ENCODING), DEFAULT_ENCODING
+    except UnicodeDecodeError:
+        pass
+    candidates = [encoding for bom, encoding in UTF16_BOMS if data.startswith(bom)]
+    for encoding in candidates + list(FALLBACK_ENCODINGS):
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return data.decode(LAST_RESORT_ENCODING), LAST_RESORT_ENCODING
+
+
+def directory_hashes(entries: Iterable[Tuple[str, str, str, Optional[str]]]) -> Dict[str, str]:
+    """
+    Compute Merkle hashes of every directory of a file tree.
+
+    A directory's hash covers the names, languages and content hashes of its
+    files and the names and hashes of its subdirectories, so two trees are
+    identical exactly when their root hashes match, and an unchanged
+    subdirectory keeps its hash.
+
+    Args:
+        entries: (rel_dir, filename, content_hash, language) of every file,
+            with '/' separated rel_dir and '' for the root
+
+    Returns:
+        Dictionary of directory path to hash; the root is ''
+    """
+    children: Dict[str, List[str]] = {"": []}
+    for rel_dir, filename, content_hash, language in entries:
+        children.setdefault(rel_dir, []).append(
+            f"blob {filename} {language or ''} {content_hash}")
+        # Make sure every ancestor is hashed, even without files of its own
+        while rel_dir and rel_dir.rpartition('/')[0] not in children:
+            rel_dir = rel_dir.rpartition('/')[0]
+            children[rel_dir] = []
+
+    hashes = {}
+    # Deepest directories first, so subdirectory hashes are known
+    for path in sorted(children, key=lambda d: d.count('/') + bool(d), reverse=True):
+        lines = "\n".join(sorted(children[path]))
+        hashes[path] = hashlib.sha1(lines.encode('utf-8')).hexdigest()
+        if path:
+            parent, _, name = path.rpartition('/')
+            children[parent].append(f"tree {name} {hashes[path]}")
+    return hashes
+
+
+def tree_hash(entries: Iterable[Tuple[str, str, str, Optional[str]]]) -> str:
+    """
+    Compute the hash of a whole file tree.
+
+    Args:
+        entries: (rel_dir, filename, content_hash, language) of every file
+
+    Returns:
+        Hash of the root directory
+    """
+    return directory_hashes(entries)[""]
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Return the column names of a table, or an empty list if it doesn't exist."""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _move_content_to_blobs(conn: sqlite3.Connection, table: str, ddl: str, columns: str) -> None:
+    """
+    Rebuild a table that carries a 'content' column so it references blobs instead.
+
+    Args:
+        conn: Open database connection
+        table: Name of the table to rebuild
+        ddl: CREATE TABLE statement with a {name} placeholder
+        columns: Comma separated columns copied unchanged
+    """
+    conn.execute(f'''
+    INSERT OR IGNORE INTO blobs (hash, size, content)
+    SELECT fltn_hash(content), length(CAST(content AS BLOB)), content
+    FROM {table}
+    ''')
+    conn.execute(ddl.format(name=f"{table}_new"))
+    conn.execute(f'''
+    INSERT INTO {table}_new ({columns}, content_hash)
+    SELECT {columns}, fltn_hash(content) FROM {table}
+    ''')
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    logger.info(f"Moved {table}.content into the blobs table")
+
+
+def _migrate_to_v1(conn: sqlite3.Connection) -> None:
+    """Create the base tables and move file contents into content-addressed blobs."""
+    for ddl in (PROJECTS_TABLE, VERSIONS_TABLE, BLOBS_TABLE, AI_DOCS_TABLE):
+        conn.execute(ddl)
+
+    if 'content' in _table_columns(conn, 'files'):
+        _move_content_to_blobs(conn, 'files', FILES_TABLE,
+                               'id, version_id, rel_path, filename, language')
+    else:
+        conn.execute(FILES_TABLE.format(name='files'))
+
+    if 'content' in _table_columns(conn, 'file_stats'):
+        _move_content_to_blobs(conn, 'file_stats', FILE_STATS_TABLE,
+                               'project_id, path, size, mtime_ns, inode')
+    else:
+        conn.execute(FILE_STATS_TABLE.format(name='file_stats'))
+
+
+def _migrate_to_v2(conn: sqlite3.Connection) -> None:
+    """Add the per-blob codec so contents can be stored compressed."""
+    conn.execute(
+        "ALTER TABLE blobs ADD COLUMN codec INTEGER NOT NULL DEFAULT 0")
+
+
+def has_fts5(conn: sqlite3.Connection) -> bool:
+    """Check whether the SQLite library was built with the FTS5 extension."""
+    options = [row[0] for row in conn.execute("PRAGMA compile_options")]
+    return "ENABLE_FTS5" in options
+
+
+def fts_enabled(conn: sqlite3.Connection) -> bool:
+    """Check whether the full-text index over blobs exists in this database."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'blob_fts'").fetchone() is not None
+
+
+def _migrate_to_v3(conn: sqlite3.Connection) -> None:
+    """Add full-text indexes over blob contents and AI docs."""
+    # Search joins matching blobs back to the files that use them
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (content_hash)")
+
+    if not has_fts5(conn):
+        logger.warning("SQLite was built without FTS5; full-text search is disabled")
+        return
+
+    # Contentless index: the text lives (possibly compressed) in blobs,
+    # and the FTS rowid is the blob id
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS blob_fts USING fts5(content, content='')")
+    rows = conn.execute("SELECT id, codec, content FROM blobs")
+    conn.executemany(
+        "INSERT INTO blob_fts (rowid, content) VALUES (?, ?)",
+        ((blob_id, decode_blob(codec, stored)) for blob_id, codec, stored in rows)
+    )
+
+    # AI docs are also written by the sqlite3 CLI, so they are kept in sync
+    # with triggers on an external content index
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS ai_docs_fts
+    USING fts5(content, content='ai_docs', content_rowid='id')
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS ai_docs_fts_insert AFTER INSERT ON ai_docs BEGIN
+        INSERT INTO ai_docs_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS ai_docs_fts_delete AFTER DELETE ON ai_docs BEGIN
+        INSERT INTO ai_docs_fts (ai_docs_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS ai_docs_fts_update AFTER UPDATE ON ai_docs BEGIN
+        INSERT INTO ai_docs_fts (ai_docs_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO ai_docs_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    ''')
+    conn.execute("INSERT INTO ai_docs_fts (ai_docs_fts) VALUES ('rebuild')")
+
+
+def _migrate_to_v4(conn: sqlite3.Connection) -> None:
+    """Add the secondary indexes used by the lookup paths."""
+    # AI docs are always read per project
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_ai_docs_project ON ai_docs (project_id, doc_number)")
+    # History of one path across versions, without scanning every file row
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_files_path ON files (rel_path, filename, version_id)")
+
+
+def _migrate_to_v5(conn: sqlite3.Connection) -> None:
+    """Add per-project head counters for atomic version allocation."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS project_heads (
+        project_id INTEGER PRIMARY KEY,
+        last_version INTEGER NOT NULL,
+        FOREIGN KEY (project_id) REFERENCES projects (id)
+    )
+    ''')
+    conn.execute('''
+    INSERT OR IGNORE INTO project_heads (project_id, last_version)
+    SELECT project_id, MAX(version_number) FROM versions GROUP BY project_id
+    ''')
+
+
+
+def _migrate_to_v6(conn: sqlite3.Connection) -> None:
+    """Add the tree hash of each version and compute it for stored versions."""
+    if "tree_hash" not in _table_columns(conn, "versions"):
+        conn.execute("ALTER TABLE versions ADD COLUMN tree_hash TEXT")
+    version_ids = [row[0] for row in conn.execute("SELECT id FROM versions")]
+    for version_id in version_ids:
+        version_hash = tree_hash(conn.execute(VERSION_ENTRIES_SQL, (version_id,)))
+        conn.execute("UPDATE versions SET tree_hash = ? WHERE id = ?", (version_hash, version_id))
+
+
+def _migrate_to_v7(conn: sqlite3.Connection) -> None:
+    """Store per-directory hashes of each version for diffing."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS trees (
+        version_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        parent_path TEXT,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (version_id, path),
+        FOREIGN KEY (version_id) REFERENCES versions (id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_trees_parent ON trees (version_id, parent_path)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_projects_name ON projects (name)")
+    version_ids = [row[0] for row in conn.execute("SELECT id FROM versions")]
+    for version_id in version_ids:
+        update_tree_hash(conn, version_id)
+
+
+def _migrate_to_v8(conn: sqlite3.Connection) -> None:
+    """Index stat cache hashes so garbage collection can check blob references."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_file_stats_content_hash ON file_stats (content_hash)")
+
+
+
+def _migrate_to_v9(conn: sqlite3.Connection) -> None:
+    """Add pack archives for cold versions."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS packs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        first_version INTEGER NOT NULL,
+        last_version INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (project_id) REFERENCES projects (id)
+    )
+    ''')
+    if "pack_id" not in _table_columns(conn, "versions"):
+        conn.execute("ALTER TABLE versions ADD COLUMN pack_id INTEGER REFERENCES packs (id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_versions_pack ON versions (pack_id)")
+
+
+def _migrate_to_v10(conn: sqlite3.Connection) -> None:
+    """Record the git commit of versions imported from a repository."""
+    if "git_commit" not in _table_columns(conn, "versions"):
+        conn.execute("ALTER TABLE versions ADD COLUMN git_commit TEXT")
+
+
+def _migrate_to_v11(conn: sqlite3.Connection) -> None:
+    """Record the encoding each file was decoded from; NULL means UTF-8."""
+    for table in ("files", "file_stats"):
+        if "encoding" not in _table_columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN encoding TEXT")
+
+
+# MIGRATIONS[n] upgrades a database from user_version n to n + 1
+MIGRATIONS = [
+    _migrate_to_v1,
+    _migrate_to_v2,
+    _migrate_to_v3,
+    _migrate_to_v4,
+    _migrate_to_v5,
+    _migrate_to_v6,
+    _migrate_to_v7,
+    _migrate_to_v8,
+    _migrate_to_v9,
+    _migrate_to_v10,
+    _migrate_to_v11,
+]
+
+
+def ensure_schema(conn: sqlite3.Connection) -> None:
+    """
+    Create or upgrade the database schema to SCHEMA_VERSION.
+
+    The schema version is tracked with PRAGMA user_version, so this is a
+    single cheap read when the database is already up to date. Each
+    migration runs under BEGIN IMMEDIATE and the version is read again
+    once the write lock is held, so processes opening the database at the
+    same time apply every migration exactly once.
+
+    Args:
+        conn: Open database connection
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    conn.create_function("fltn_hash", 1, hash_content, deterministic=True)
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                # Another process finished the upgrade while we waited
+                conn.rollback()
+                return
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Database schema upgraded to version {version + 1}")
+
+
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """
+    Open a new connection with the tool's settings and an up-to-date schema.
+
+    WAL mode lets readers and a writer work at the same time, and the busy
+    timeout makes concurrent fltn runs wait for each other instead of
+    failing with "database is locked".
+
+    Args:
+        db_path: Path to the SQLite database
+
+    Returns:
+        Open database connection
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+    # Only takes effect for a new database; `fltn gc` converts older ones
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    ensure_schema(conn)
+    return conn
+
+
+def get_connection(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """
+    Get the connection shared by the whole run, opening it on first use.
+
+    Args:
+        db_path: Path to the SQLite database
+
+    Returns:
+        Open database connection
+    """
+    conn = _connections.get(db_path)
+    if conn is None:
+        conn = connect(db_path)
+        _connections[db_path] = conn
+    return conn
+
+
+@atexit.register
+def close_connections() -> None:
+    """Close every shared connection, rolling back unfinished transactions."""
+    while _connections:
+        _, conn = _connections.popitem()
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Error closing database connection: {e}")
+
+
+def register_project(conn: sqlite3.Connection, project_path: str) -> int:
+    """
+    Register a project by path, or get its ID if it is already registered.
+
+    Args:
+        conn: Open database connection
+        project_path: Absolute path to the project root
+
+    Returns:
+        Database ID of the project
+    """
+    conn.execute(REGISTER_PROJECT_SQL, (os.path.basename(project_path), project_path))
+    conn.commit()
+    return conn.execute(PROJECT_BY_PATH_SQL, (project_path,)).fetchone()[0]
+
+
+def head_version(conn: sqlite3.Connection, project_id: int) -> Optional[Tuple[int, int, Optional[str]]]:
+    """
+    Get the latest version of a project.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+
+    Returns:
+        Tuple of version_id, version_number and tree_hash, or None if the
+        project has no versions
+    """
+    return conn.execute(HEAD_VERSION_SQL, (project_id,)).fetchone()
+
+
+def store_tree(conn: sqlite3.Connection, version_id: int, hashes: Dict[str, str]) -> str:
+    """
+    Store the directory hashes of a version and set its tree hash.
+
+    The caller is responsible for committing.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+        hashes: Directory hashes from directory_hashes
+
+    Returns:
+        The version's tree hash
+    """
+    conn.execute("DELETE FROM trees WHERE version_id = ?", (version_id,))
+    conn.executemany(
+        "INSERT INTO trees (version_id, path, parent_path, hash) VALUES (?, ?, ?, ?)",
+        [(version_id, path, path.rpartition('/')[0] if path else None, dir_hash)
+         for path, dir_hash in hashes.items()]
+    )
+    conn.execute("UPDATE versions SET tree_hash = ? WHERE id = ?", (hashes[""], version_id))
+    return hashes[""]
+
+
+def update_tree_hash(conn: sqlite3.Connection, version_id: int) -> str:
+    """
+    Recompute and store the directory and tree hashes of a version from its file rows.
+
+    The caller is responsible for committing.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+
+    Returns:
+        The version's tree hash
+    """
+    hashes = directory_hashes(conn.execute(VERSION_ENTRIES_SQL, (version_id,)))
+    return store_tree(conn, version_id, hashes)
+
+
+def insert_version(conn: sqlite3.Connection, project_id: int) -> Tuple[int, int]:
+    """
+    Allocate the next version number of a project and create the version.
+
+    The caller must hold the write lock (BEGIN IMMEDIATE), so the version
+    can be created in the same transaction that stores its files.
+
+    Args:
+        conn: Open database connection inside a BEGIN IMMEDIATE transaction
+        project_id: Database ID of the project
+
+    Returns:
+        Tuple containing version_id and version_number
+    """
+    version_number = conn.execute(
+        ALLOCATE_VERSION_SQL, {"project_id": project_id}).fetchone()[0]
+    cursor = conn.execute(
+        "INSERT INTO versions (project_id, version_number) VALUES (?, ?)",
+        (project_id, version_number)
+    )
+    return cursor.lastrowid, version_number
+
+
+def allocate_version(conn: sqlite3.Connection, project_id: int) -> Tuple[int, int]:
+    """
+    Atomically allocate the next version number of a project and create it.
+
+    The project's head counter row is bumped under BEGIN IMMEDIATE, so
+    concurrent writers are serialized by SQLite's write lock (waiting up to
+    the busy timeout) and never race for the same number.
+
+    Args:
+        conn: Open database connection with no transaction in progress
+        project_id: Database ID of the project
+
+    Returns:
+        Tuple containing version_id and version_number
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version_id, version_number = insert_version(conn, project_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version_id, version_number
+
+
+def codec_from_settings(settings: Dict) -> int:
+    """
+    Get the blob codec selected by the "compression" setting.
+
+    Args:
+        settings: Contents of appsettings.json
+
+    Returns:
+        One of the CODEC_* constants, CODEC_RAW if the setting is missing or unknown
+    """
+    name = str(settings.get("compression", "none")).lower()
+    if name not in CODECS_BY_NAME:
+        logger.warning(f"Unknown compression '{name}', storing contents uncompressed")
+    return CODECS_BY_NAME.get(name, CODEC_RAW)
+
+
+def encode_blob(content: str, codec: int = CODEC_RAW,
+                level: int = DEFAULT_COMPRESSION_LEVEL) -> Tuple[int, Union[str, bytes]]:
+    """
+    Encode contents for the blobs table.
+
+    Compressed output that is not smaller than the text is stored raw, so
+    tiny files never pay for the codec.
+
+    Args:
+        content: File contents
+        codec: Requested CODEC_* constant
+        level: zlib compression level
+
+    Returns:
+        Tuple of the codec actually used and the value for the content column
+    """
+    if codec == CODEC_ZLIB:
+        data = content.encode('utf-8')
+        packed = zlib.compress(data, level)
+        if len(packed) < len(data):
+            return CODEC_ZLIB, packed
+    return CODEC_RAW, content
+
+
+def decode_blob(codec: int, stored: Union[str, bytes]) -> str:
+    """
+    Decode a value from the content column of the blobs table.
+
+    Args:
+        codec: CODEC_* constant stored with the blob
+        stored: Value of the content column
+
+    Returns:
+        File contents
+    """
+    if codec == CODEC_RAW:
+        return stored
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(stored).decode('utf-8')
+    if codec == CODEC_EXTERNAL:
+        with open(external_blob_path(stored), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+    raise ValueError(f"Unknown blob codec: {codec}")
+
+
+def iter_blob_chunks(codec: int, stored: Union[str, bytes]) -> Iterator[str]:
+    """
+    Decode a value from the content column of the blobs table piece by piece.
+
+    External blobs are streamed from their file, so writing one out never
+    holds the whole contents in memory; other blobs are decoded at once.
+
+    Args:
+        codec: CODEC_* constant stored with the blob
+        stored: Value of the content column
+
+    Yields:
+        Consecutive pieces of the file contents
+    """
+    if codec != CODEC_EXTERNAL:
+        yield decode_blob(codec, stored)
+        return
+    with open(external_blob_path(stored), 'r', encoding='utf-8', newline='') as f:
+        while True:
+            chunk = f.read(EXTERNAL_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def external_blob_path(name: str) -> str:
+    """Absolute path of an external blob from its '/' separated name."""
+    return os.path.join(BLOBS_DIR, *name.split('/'))
+
+
+def write_external_blob(data) -> Optional[Tuple[str, str]]:
+    """
+    Copy UTF-8 file contents into the external blob store.
+
+    The contents are hashed, validated and copied in a single pass over
+    `data`, typically a memory map of the source file, then moved into place
+    under their hash. Hashing the raw bytes gives the same hash as
+    hash_content on the decoded text, because valid UTF-8 round-trips.
+
+    Args:
+        data: Buffer holding the file contents, e.g. an mmap.mmap
+
+    Returns:
+        Tuple of the content hash and the blob's name, or None if the
+        contents are not valid UTF-8 and have to be stored the usual way
+    """
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+    hasher = hashlib.sha1()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    fd, temp_path = tempfile.mkstemp(dir=BLOBS_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as out, memoryview(data) as view:
+            for offset in range(0, len(view), EXTERNAL_CHUNK_SIZE):
+                chunk = view[offset:offset + EXTERNAL_CHUNK_SIZE]
+                decoder.decode(chunk)
+                hasher.update(chunk)
+                out.write(chunk)
+                chunk.release()
+            decoder.decode(b"", final=True)
+        content_hash = hasher.hexdigest()
+        name = f"{content_hash[:2]}/{content_hash}"
+        path = external_blob_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    except UnicodeDecodeError:
+        os.remove(temp_path)
+        return None
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return content_hash, name
+
+
+def store_external_blobs(conn: sqlite3.Connection, blobs: Dict[str, Tuple[str, int]]) -> int:
+    """
+    Record external blobs written by write_external_blob.
+
+    Contents already stored in the database keep their row, and the copy
+    that was just written is removed again. External blobs are not added
+    to the full-text index.
+
+    Args:
+        conn: Open database connection
+        blobs: Dictionary mapping content hash to (blob name, size in bytes)
+
+    Returns:
+        Number of new blobs inserted
+    """
+    hashes = list(blobs)
+    existing = {}
+    for i in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+        chunk = hashes[i:i + LOOKUP_CHUNK_SIZE]
+        placeholders = ",".join("?" * len(chunk))
+        existing.update(conn.execute(
+            EXTERNAL_LOOKUP_SQL.format(placeholders=placeholders), chunk))
+
+    new_rows = []
+    for h in hashes:
+        name, size = blobs[h]
+        if h not in existing:
+            new_rows.append((h, size, CODEC_EXTERNAL, name))
+        elif existing[h] != CODEC_EXTERNAL:
+            try:
+                os.remove(external_blob_path(name))
+            except OSError as e:
+                logger.warning(f"Could not remove duplicate blob file {name}: {e}")
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO blobs (hash, size, codec, content) VALUES (?, ?, ?, ?)",
+        new_rows
+    )
+    return len(new_rows)
+
+
+def store_blobs(conn: sqlite3.Connection, blobs: Dict[str, str],
+                codec: int = CODEC_RAW) -> int:
+    """
+    Store file contents that are not in the blobs table yet.
+
+    Existing hashes are looked up first, so contents that are already
+    stored are never encoded, written or indexed again. Call this inside a
+    transaction started with BEGIN IMMEDIATE: a deferred transaction that
+    reads first cannot take the write lock later while another process
+    holds it, and fails with "database is locked" at once.
+
+    Args:
+        conn: Open database connection
+        blobs: Dictionary mapping content hash to content
+        codec: CODEC_* constant used for new blobs
+
+    Returns:
+        Number of new blobs inserted
+    """
+    hashes = list(blobs)
+    existing = set()
+    for i in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+        chunk = hashes[i:i + LOOKUP_CHUNK_SIZE]
+        placeholders = ",".join("?" * len(chunk))
+        existing.update(row[0] for row in conn.execute(
+            BLOB_LOOKUP_SQL.format(placeholders=placeholders), chunk))
+
+    new_rows = []
+    for h in hashes:
+        if h in existing:
+            continue
+        content = blobs[h]
+        used_codec, stored = encode_blob(content, codec)
+        new_rows.append((h, len(content.encode('utf-8')), used_codec, stored))
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO blobs (hash, size, codec, content) VALUES (?, ?, ?, ?)",
+        new_rows
+    )
+
+    # Keep the full-text index in step with the new contents
+    if new_rows and fts_enabled(conn):
+        conn.executemany(
+            "INSERT INTO blob_fts (rowid, content) SELECT id, ? FROM blobs WHERE hash = ?",
+            ((blobs[row[0]], row[0]) for row in new_rows)
+        )
+    return len(new_rows)
+
+
+def read_blob(conn: sqlite3.Connection, content_hash: str) -> str:
+    """
+    Read the contents stored under a hash, decompressing them if needed.
+
+    Args:
+        conn: Open database connection
+        content_hash: Hash of the contents
+
+    Returns:
+        File contents
+    """
+    row = conn.execute(READ_BLOB_SQL, (content_hash,)).fetchone()
+    if row is None:
+        raise KeyError(f"Blob not found: {content_hash}")
+    return decode_blob(*row)
+
+
+def file_history(conn: sqlite3.Connection, project_id: int, rel_path: str,
+                 filename: str) -> List[Dict]:
+    """
+    List every stored version of one file of a project.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        rel_path: Directory of the file relative to the project root
+        filename: Name of the file
+
+    Returns:
+        List of dictionaries with version, created_at, content_hash and language
+    """
+    rows = conn.execute(FILE_HISTORY_SQL, (rel_path, filename, project_id))
+    return [{'version': version, 'created_at': created_at,
+             'content_hash': content_hash, 'language': language}
+            for version, created_at, content_hash, language in rows]
+
+
+def explain_query_plan(conn: sqlite3.Connection, sql: str) -> List[str]:
+    """
+    Run a query under EXPLAIN QUERY PLAN with all parameters bound to NULL.
+
+    Args:
+        conn: Open database connection
+        sql: Query to explain, with ? or :name parameters
+
+    Returns:
+        The detail column of each plan step
+    """
+    names = re.findall(r':(\w+)', sql)
+    params = {name: None for name in names} if names else (None,) * sql.count('?')
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def full_scans(conn: sqlite3.Connection, plan: List[str]) -> List[str]:
+    """
+    Find the plan steps that scan a whole table or index.
+
+    Both plan formats are understood: 'SCAN f USING COVERING INDEX i' since
+    SQLite 3.36 and 'SCAN TABLE files AS f USING COVERING INDEX i' before.
+    Tables usually appear under their alias, so any SCAN step is flagged
+    unless it reads a virtual table, a subquery, a common table expression
+    or a constant row. Index lookups with a search constraint show up as
+    SEARCH steps and are never flagged.
+
+    Args:
+        conn: Open database connection
+        plan: Detail strings from explain_query_plan
+
+    Returns:
+        Names (or aliases) of the tables that are scanned in full
+    """
+    # Subqueries and common table expressions are scanned under their own names
+    subqueries = {match.group(1) for match in (
+        re.match(r'(?:MATERIALIZE|CO-ROUTINE) (\S+)', detail) for detail in plan) if match}
+    scanned = []
+    for detail in plan:
+        match = re.match(r'SCAN (TABLE )?(\S+)(?: AS (\S+))?(.*)', detail)
+        if not match:
+            continue
+        keyword, name, alias, rest = match.groups()
+        if not keyword and (name in subqueries or name.startswith('(')
+                            or re.match(r'SCAN (CONSTANT ROW|SUBQUERY \d)', detail)):
+            continue
+        if "VIRTUAL TABLE" in rest or re.search(r'USING .*INDEX .*\(', rest):
+            continue
+        scanned.append(alias or name)
+    return scanned
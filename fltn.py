@@ -0,0 +1,416 @@
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+import subprocess
+from datetime import datetime
+from typing import List, Tuple
+
+from flattener import DEFAULT_WORKERS, OUTPUT_FORMATS, OUTPUT_MARKDOWN
+from flattener_db import DATABASE_DIR, get_connection
+
+LOGS_DIR = os.path.join(DATABASE_DIR, "logs")
+
+logger = logging.getLogger("fltn")
+
+
+def configure_logging() -> None:
+    """Send log output to the central logs folder and the console."""
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    log_file = os.path.join(
+        LOGS_DIR, f"fltn_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
+
+
+def cmd_snapshot(options: argparse.Namespace) -> int:
+    """Run `fltn snapshot`."""
+    from snapshot import take_snapshot
+
+    try:
+        result = take_snapshot(options.path, options.workers)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Snapshot failed: {e}")
+        return 1
+
+    # Only the output path goes to stdout, so scripts can capture it
+    print(result['output_path'])
+    return 0
+
+
+def cmd_search(options: argparse.Namespace) -> int:
+    """Run `fltn search`."""
+    import search
+
+    conn = get_connection()
+    try:
+        if options.docs:
+            hits = search.search_docs(
+                conn, options.query, options.project, options.limit)
+            for hit in hits:
+                print(f"{hit['project']} doc {hit['doc_number']} ({hit['created_at']})")
+                print(f"    {hit['snippet']}")
+        else:
+            hits = search.search_files(
+                conn, options.query, options.project, options.version, options.limit)
+            for hit in hits:
+                print(f"{hit['project']} v{hit['version']} {hit['path']}")
+                for line in hit['snippet'].splitlines():
+                    print(f"    {line}")
+    except (sqlite3.OperationalError, RuntimeError) as e:
+        logger.error(f"Search failed: {e}")
+        return 1
+
+    if not hits:
+        print("No matches found.")
+    return 0
+
+
+def cmd_diff(options: argparse.Namespace) -> int:
+    """Run `fltn diff`."""
+    import history
+
+    conn = get_connection()
+    try:
+        project_id = history.find_project(conn, options.project)
+        old_version_id, _ = history.find_version(conn, project_id, options.old)
+        new_version_id, _ = history.find_version(conn, project_id, options.new)
+    except LookupError as e:
+        logger.error(str(e))
+        return 1
+
+    if options.name_status:
+        for status, path, _, _ in history.diff_versions(conn, old_version_id, new_version_id):
+            print(f"{status}\t{path}")
+    else:
+        sys.stdout.writelines(
+            history.iter_unified_diff(conn, old_version_id, new_version_id, options.context))
+    return 0
+
+
+def cmd_checkout(options: argparse.Namespace) -> int:
+    """Run `fltn checkout`."""
+    import history
+
+    conn = get_connection()
+    try:
+        project_id = history.find_project(conn, options.project)
+        version_id, _ = history.find_version(conn, project_id, options.version)
+    except LookupError as e:
+        logger.error(str(e))
+        return 1
+
+    if os.path.isdir(options.dest) and os.listdir(options.dest) and not options.force:
+        logger.error(f"{options.dest} is not empty; use --force to write into it anyway")
+        return 1
+
+    try:
+        history.checkout_version(conn, version_id, options.dest, options.workers)
+    except OSError as e:
+        logger.error(f"Checkout failed: {e}")
+        return 1
+    return 0
+
+
+def cmd_export(options: argparse.Namespace) -> int:
+    """Run `fltn export`."""
+    import history
+
+    conn = get_connection()
+    try:
+        project_id = history.find_project(conn, options.project)
+        version_id, _ = history.find_version(conn, project_id, options.version)
+    except LookupError as e:
+        logger.error(str(e))
+        return 1
+
+    if options.output:
+        with open(options.output, 'wb') as out:
+            result = history.export_version(conn, version_id, out, options.format)
+    else:
+        # Written as UTF-8 without newline translation, like the output files
+        result = history.export_version(conn, version_id, sys.stdout.buffer, options.format)
+        sys.stdout.buffer.flush()
+    logger.info(f"Exported {result['files']} files of version {options.version}")
+    return 0
+
+
+def cmd_gc(options: argparse.Namespace) -> int:
+    """Run `fltn gc`."""
+    import history
+    import retention
+
+    conn = get_connection()
+    project_id = None
+    if options.project:
+        try:
+            project_id = history.find_project(conn, options.project)
+        except LookupError as e:
+            logger.error(str(e))
+            return 1
+
+    result = retention.collect_garbage(conn, project_id, options.dry_run, not options.no_vacuum,
+                                       options.full_vacuum)
+    verb = "Would prune" if options.dry_run else "Pruned"
+    for name, numbers in result['pruned'].items():
+        print(f"{verb} {name}: {', '.join(f'v{n}' for n in sorted(numbers))}")
+    print(f"{'Would delete' if options.dry_run else 'Deleted'} {result['blobs']} unreferenced "
+          f"contents ({result['blob_bytes'] / 1e6:.1f} MB), freed {result['freed_pages']} pages")
+    return 0
+
+
+def cmd_pack(options: argparse.Namespace) -> int:
+    """Run `fltn pack`."""
+    import history
+    import packfile
+
+    conn = get_connection()
+    try:
+        project_id = history.find_project(conn, options.project)
+    except LookupError as e:
+        logger.error(str(e))
+        return 1
+
+    try:
+        result = packfile.pack_versions(conn, project_id, options.first, options.last)
+    except RuntimeError as e:
+        logger.error(str(e))
+        return 1
+    if result is None:
+        print("No unpacked versions in that range (the latest version is never packed).")
+        return 0
+    print(f"Packed {len(result['versions'])} versions ({result['entries']} files, "
+          f"{result['bytes'] / 1e6:.1f} MB) into {result['path']}")
+    print("Run 'fltn gc' to reclaim the space in the database.")
+    return 0
+
+
+def cmd_import_history(options: argparse.Namespace) -> int:
+    """Run `fltn import-history`."""
+    import history
+    import importers
+    from flattener_db import register_project
+
+    conn = get_connection()
+    try:
+        project_id = history.find_project(conn, options.project)
+    except LookupError as e:
+        if not os.path.isdir(options.project):
+            logger.error(str(e))
+            return 1
+        project_id = register_project(conn, os.path.abspath(options.project))
+    root_folder = conn.execute(
+        "SELECT path FROM projects WHERE id = ?", (project_id,)).fetchone()[0]
+
+    result = importers.import_history(conn, project_id, root_folder, options.processes)
+    print(f"Imported {result['imported']} versions ({result['files']} files) in "
+          f"{result['seconds']:.1f}s; {result['skipped']} already stored, {result['failed']} failed")
+    return 1 if result['failed'] else 0
+
+
+def cmd_import_git(options: argparse.Namespace) -> int:
+    """Run `fltn import-git`."""
+    import importers
+    from flattener_db import register_project
+
+    repo = os.path.abspath(options.repo)
+    if not os.path.isdir(repo):
+        logger.error(f"Not a directory: {repo}")
+        return 1
+
+    conn = get_connection()
+    project_id = register_project(conn, repo)
+    try:
+        result = importers.import_git(conn, project_id, repo, options.rev_range)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f"Import failed: {e}")
+        return 1
+    print(f"Imported {result['imported']} commits in {result['seconds']:.1f}s; "
+          f"{result['skipped']} already imported")
+    return 0
+
+
+def builtin_queries() -> List[Tuple[str, str]]:
+    """List the (name, sql) of every query the tool runs on its hot paths."""
+    import flattener
+    import flattener_db
+    import packfile
+    import search
+
+    return [
+        ("project by path", flattener_db.PROJECT_BY_PATH_SQL),
+        ("register project", flattener_db.REGISTER_PROJECT_SQL),
+        ("head version", flattener_db.HEAD_VERSION_SQL),
+        ("allocate version", flattener_db.ALLOCATE_VERSION_SQL),
+        ("version entries", flattener_db.VERSION_ENTRIES_SQL),
+        ("blob lookup", flattener_db.BLOB_LOOKUP_SQL.format(placeholders="?")),
+        ("read blob", flattener_db.READ_BLOB_SQL),
+        ("file history", flattener_db.FILE_HISTORY_SQL),
+        ("project by name", flattener_db.PROJECT_BY_NAME_SQL),
+        ("version by number", flattener_db.VERSION_BY_NUMBER_SQL),
+        ("tree children", flattener_db.TREE_CHILDREN_SQL),
+        ("directory files", flattener_db.DIR_FILES_SQL),
+        ("version dirs", flattener_db.VERSION_DIRS_SQL),
+        ("version files", flattener_db.VERSION_FILES_SQL),
+        ("version pack", packfile.VERSION_PACK_SQL),
+        ("stat cache", flattener.STAT_CACHE_SQL),
+        ("upsert file", flattener_db.UPSERT_FILE_SQL),
+        ("search files", search.SEARCH_FILES_SQL),
+        ("search docs", search.SEARCH_DOCS_SQL),
+    ]
+
+
+def cmd_db_explain(options: argparse.Namespace) -> int:
+    """Run `fltn db explain`."""
+    from flattener_db import explain_query_plan, full_scans
+
+    conn = get_connection()
+    flagged = 0
+    for name, sql in builtin_queries():
+        plan = explain_query_plan(conn, sql)
+        scans = full_scans(conn, plan)
+        flagged += bool(scans)
+        status = f"FULL SCAN of {', '.join(scans)}" if scans else "ok"
+        print(f"{name}: {status}")
+        for detail in plan:
+            print(f"    {detail}")
+
+    print(f"{flagged} of {len(builtin_queries())} queries scan a whole table.")
+    return 1 if flagged else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the argument parser for all fltn commands."""
+    parser = argparse.ArgumentParser(
+        prog="fltn",
+        description="CodeFlattener VCS. Run 'fltn [path]' to set up a project, "
+                    "or one of the commands below.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    snapshot_parser = commands.add_parser(
+        "snapshot", help="Store the project as a new version and write its flattened markdown")
+    snapshot_parser.add_argument("path", nargs="?", default=".",
+                                 help="Project root (defaults to the current directory)")
+    snapshot_parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                                 help="Number of reader threads")
+    snapshot_parser.set_defaults(func=cmd_snapshot)
+
+    search_parser = commands.add_parser(
+        "search", help="Full-text search over stored files and AI docs")
+    search_parser.add_argument("query", help="FTS5 query, e.g. 'parse AND sqlite'")
+    search_parser.add_argument("-p", "--project", help="Project name or path")
+    search_parser.add_argument("-v", "--version", type=int, help="Version number")
+    search_parser.add_argument("-n", "--limit", type=int, default=20,
+                               help="Maximum number of hits")
+    search_parser.add_argument("--docs", action="store_true",
+                               help="Search AI docs instead of files")
+    search_parser.set_defaults(func=cmd_search)
+
+    diff_parser = commands.add_parser(
+        "diff", help="Show the changes between two stored versions of a project")
+    diff_parser.add_argument("project", help="Project name or path")
+    diff_parser.add_argument("old", type=int, help="Version number to compare from")
+    diff_parser.add_argument("new", type=int, help="Version number to compare to")
+    diff_parser.add_argument("--name-status", action="store_true",
+                             help="Only list changed paths with A/D/M status")
+    diff_parser.add_argument("-U", "--context", type=int, default=3,
+                             help="Lines of context in the unified diff")
+    diff_parser.set_defaults(func=cmd_diff)
+
+    checkout_parser = commands.add_parser(
+        "checkout", help="Write the files of a stored version to a directory")
+    checkout_parser.add_argument("project", help="Project name or path")
+    checkout_parser.add_argument("version", type=int, help="Version number")
+    checkout_parser.add_argument("dest", help="Directory to write the files to")
+    checkout_parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+                                 help="Number of writer threads")
+    checkout_parser.add_argument("--force", action="store_true",
+                                 help="Write into a non-empty directory, overwriting files")
+    checkout_parser.set_defaults(func=cmd_checkout)
+
+    export_parser = commands.add_parser(
+        "export", help="Write the flattened markdown of a stored version")
+    export_parser.add_argument("project", help="Project name or path")
+    export_parser.add_argument("version", type=int, help="Version number")
+    export_parser.add_argument("-o", "--output", help="File to write (defaults to stdout)")
+    export_parser.add_argument("--format", choices=OUTPUT_FORMATS, default=OUTPUT_MARKDOWN,
+                               help="Output layout; framed adds byte lengths and an offset index")
+    export_parser.set_defaults(func=cmd_export)
+
+    gc_parser = commands.add_parser(
+        "gc", help="Prune versions by retention policy and reclaim database space")
+    gc_parser.add_argument("-p", "--project", help="Only prune this project (name or path)")
+    gc_parser.add_argument("-n", "--dry-run", action="store_true",
+                           help="Only report what would be deleted")
+    gc_parser.add_argument("--no-vacuum", action="store_true",
+                           help="Do not return freed pages to the file system")
+    gc_parser.add_argument("--full-vacuum", action="store_true",
+                           help="Convert a database from an older release with a one-time "
+                                "full VACUUM (blocks other writers while it runs)")
+    gc_parser.set_defaults(func=cmd_gc)
+
+    pack_parser = commands.add_parser(
+        "pack", help="Move a range of versions into a compressed archive file")
+    pack_parser.add_argument("project", help="Project name or path")
+    pack_parser.add_argument("first", type=int, help="First version number to pack")
+    pack_parser.add_argument("last", type=int, help="Last version number to pack")
+    pack_parser.set_defaults(func=cmd_pack)
+
+    import_history_parser = commands.add_parser(
+        "import-history", help="Store the versions of existing .dev/versions outputs")
+    import_history_parser.add_argument("project", help="Project name or path")
+    import_history_parser.add_argument("-j", "--processes", type=int,
+                                       help="Number of parser processes (defaults to the CPU count)")
+    import_history_parser.set_defaults(func=cmd_import_history)
+
+    import_git_parser = commands.add_parser(
+        "import-git", help="Store the commits of a git repository as versions")
+    import_git_parser.add_argument("repo", help="Path to the repository (the project root)")
+    import_git_parser.add_argument("rev_range", nargs="?", default="HEAD",
+                                   help="Revision range, e.g. 'v1.0..main' (defaults to HEAD)")
+    import_git_parser.set_defaults(func=cmd_import_git)
+
+    db_parser = commands.add_parser("db", help="Database maintenance")
+    db_commands = db_parser.add_subparsers(dest="db_command", metavar="command", required=True)
+    explain_parser = db_commands.add_parser(
+        "explain", help="Show the query plan of each built-in query and flag full scans")
+    explain_parser.set_defaults(func=cmd_db_explain)
+
+    # Kept so main() can tell command names from project paths
+    parser.commands = commands.choices
+    return parser
+
+
+def main(args: List[str]) -> None:
+    """
+    Main entry point for the fltn command.
+
+    Args:
+        args: Command-line arguments.
+    """
+    parser = build_parser()
+
+    if not args or (args[0] not in parser.commands and not args[0].startswith('-')):
+        # `fltn [path]` keeps setting up the project as before
+        import setup_flattener_vcs
+        setup_flattener_vcs.main(args)
+        return
+
+    options = parser.parse_args(args)
+    if not options.command:
+        parser.print_help()
+        return
+
+    configure_logging()
+    sys.exit(options.func(options))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,294 @@
+import os
+import difflib
+import logging
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple, Union
+
+from flattener import DEFAULT_WORKERS, OUTPUT_MARKDOWN, write_output
+from flattener_db import (DIR_FILES_SQL, PROJECT_BY_NAME_SQL, PROJECT_BY_PATH_SQL,
+                          TREE_CHILDREN_SQL, VERSION_BY_NUMBER_SQL, VERSION_DIRS_SQL,
+                          DEFAULT_ENCODING, VERSION_FILES_SQL, iter_blob_chunks, read_blob)
+from packfile import PackFile, version_pack
+
+logger = logging.getLogger("History")
+
+# Change kinds reported by diff_versions, as in `git diff --name-status`
+ADDED = "A"
+DELETED = "D"
+MODIFIED = "M"
+
+
+def find_project(conn: sqlite3.Connection, project: str) -> int:
+    """
+    Look up a project by path or name.
+
+    Args:
+        conn: Open database connection
+        project: Project root folder, stored path or name
+
+    Returns:
+        Database ID of the project
+
+    Raises:
+        LookupError: If no project matches
+    """
+    row = None
+    if os.path.isdir(project):
+        row = conn.execute(PROJECT_BY_PATH_SQL, (os.path.abspath(project),)).fetchone()
+    if row is None:
+        row = conn.execute(PROJECT_BY_PATH_SQL, (project,)).fetchone()
+    if row is None:
+        row = conn.execute(PROJECT_BY_NAME_SQL, (project,)).fetchone()
+    if row is None:
+        raise LookupError(f"Unknown project: {project}")
+    return row[0]
+
+
+def find_version(conn: sqlite3.Connection, project_id: int,
+                 version_number: int) -> Tuple[int, Optional[str]]:
+    """
+    Look up a version of a project by number.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        version_number: Version number
+
+    Returns:
+        Tuple of version_id and tree_hash
+
+    Raises:
+        LookupError: If the project has no such version
+    """
+    row = conn.execute(VERSION_BY_NUMBER_SQL, (project_id, version_number)).fetchone()
+    if row is None:
+        raise LookupError(f"Unknown version: {version_number}")
+    return row
+
+
+def _join(rel_dir: str, name: str) -> str:
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+
+def _dir_files(conn: sqlite3.Connection, version_id: int,
+               packed: Optional[Tuple[PackFile, int]], rel_dir: str) -> Dict[str, str]:
+    """Map the file names of one directory of a version to their content hashes."""
+    if packed is not None:
+        pack, version_number = packed
+        return pack.dir_files(version_number, rel_dir)
+    return dict(conn.execute(DIR_FILES_SQL, (version_id, rel_dir)))
+
+
+def _read_content(conn: sqlite3.Connection, content_hash: str, packs) -> str:
+    """Read contents from the database, or from the packs of the versions being compared."""
+    try:
+        return read_blob(conn, content_hash)
+    except KeyError:
+        for packed in packs:
+            content = packed[0].read(content_hash) if packed else None
+            if content is not None:
+                return content
+        raise
+
+
+def diff_versions(conn: sqlite3.Connection, old_version_id: int,
+                  new_version_id: int) -> Iterator[Tuple[str, str, Optional[str], Optional[str]]]:
+    """
+    List the files that differ between two versions.
+
+    Walks both directory trees from the root and only descends into
+    directories whose stored hashes differ, so the work done is proportional
+    to the number of changed directories, not the size of the project.
+
+    Args:
+        conn: Open database connection
+        old_version_id: Database ID of the version to compare from
+        new_version_id: Database ID of the version to compare to
+
+    Yields:
+        Tuples of (status, path, old content hash, new content hash), where
+        status is ADDED, DELETED or MODIFIED
+    """
+    roots = {}
+    packs = {}
+    for version_id in (old_version_id, new_version_id):
+        packs[version_id] = version_pack(conn, version_id)
+        row = conn.execute(
+            "SELECT hash FROM trees WHERE version_id = ? AND path = ''", (version_id,)).fetchone()
+        roots[version_id] = row[0] if row else None
+
+    # (directory, hash in old version, hash in new version)
+    stack = [("", roots[old_version_id], roots[new_version_id])]
+    while stack:
+        rel_dir, old_hash, new_hash = stack.pop()
+        if old_hash == new_hash:
+            continue
+
+        old_files = _dir_files(conn, old_version_id, packs[old_version_id], rel_dir) if old_hash else {}
+        new_files = _dir_files(conn, new_version_id, packs[new_version_id], rel_dir) if new_hash else {}
+        for filename in sorted(old_files.keys() | new_files.keys()):
+            old_content = old_files.get(filename)
+            new_content = new_files.get(filename)
+            if old_content == new_content:
+                continue
+            status = ADDED if old_content is None else DELETED if new_content is None else MODIFIED
+            yield status, _join(rel_dir, filename), old_content, new_content
+
+        old_dirs = dict(conn.execute(TREE_CHILDREN_SQL, (old_version_id, rel_dir))) if old_hash else {}
+        new_dirs = dict(conn.execute(TREE_CHILDREN_SQL, (new_version_id, rel_dir))) if new_hash else {}
+        # Pushed in reverse so subdirectories come out in sorted order
+        for path in sorted(old_dirs.keys() | new_dirs.keys(), reverse=True):
+            stack.append((path, old_dirs.get(path), new_dirs.get(path)))
+
+
+def iter_unified_diff(conn: sqlite3.Connection, old_version_id: int, new_version_id: int,
+                      context: int = 3) -> Iterator[str]:
+    """
+    Stream a unified diff between two versions.
+
+    Contents are read one changed file at a time, so memory use is bounded
+    by the largest changed file.
+
+    Args:
+        conn: Open database connection
+        old_version_id: Database ID of the version to compare from
+        new_version_id: Database ID of the version to compare to
+        context: Number of context lines around each change
+
+    Yields:
+        Lines of the diff, each ending with a newline
+    """
+    packs = [version_pack(conn, old_version_id), version_pack(conn, new_version_id)]
+    for status, path, old_hash, new_hash in diff_versions(conn, old_version_id, new_version_id):
+        old_lines = _read_content(conn, old_hash, packs).splitlines(keepends=True) if old_hash else []
+        new_lines = _read_content(conn, new_hash, packs).splitlines(keepends=True) if new_hash else []
+        old_name = f"a/{path}" if old_hash else "/dev/null"
+        new_name = f"b/{path}" if new_hash else "/dev/null"
+        for line in difflib.unified_diff(old_lines, new_lines, old_name, new_name, n=context):
+            yield line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+
+
+def iter_version_files(conn: sqlite3.Connection,
+                       version_id: int) -> Iterator[Tuple[str, str, str, int, Union[str, bytes],
+                                                          Optional[str]]]:
+    """
+    Stream the files of a version in flattened output order.
+
+    Contents are returned as stored, so callers can decode them where it
+    suits them, e.g. on worker threads. Packed versions are read from their
+    pack file.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+
+    Yields:
+        Tuples of (rel_dir, filename, language, codec, stored content,
+        encoding the file was decoded from, None for UTF-8)
+    """
+    packed = version_pack(conn, version_id)
+    if packed is not None:
+        pack, version_number = packed
+        yield from pack.version_files(version_number)
+    else:
+        yield from conn.execute(VERSION_FILES_SQL, (version_id,))
+
+
+def _target_path(dest: str, rel_dir: str, filename: str = "") -> Optional[str]:
+    """Resolve a stored path under dest, or None if it would escape it."""
+    target = os.path.normpath(os.path.join(dest, *rel_dir.split('/'), filename))
+    if target != dest and not target.startswith(dest + os.sep):
+        return None
+    return target
+
+
+def _write_file(path: str, codec: int, stored: Union[str, bytes],
+                encoding: Optional[str] = None) -> int:
+    """
+    Decode stored contents and write them to path in their original encoding,
+    returning the number of characters written.
+    """
+    written = 0
+    with open(path, 'w', encoding=encoding or DEFAULT_ENCODING, newline='') as f:
+        for chunk in iter_blob_chunks(codec, stored):
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def checkout_version(conn: sqlite3.Connection, version_id: int, dest: str,
+                     workers: int = DEFAULT_WORKERS) -> Dict:
+    """
+    Write the files of a stored version to a directory.
+
+    All directories are created up front, then contents are streamed from
+    the database and decoded and written on a thread pool. Files are
+    written in the encoding they were read in, so they match the originals. Only a bounded
+    window of files is in flight, so memory stays flat for large versions.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+        dest: Directory to write the files to
+        workers: Number of writer threads
+
+    Returns:
+        Dictionary with the number of files and characters written and seconds taken
+    """
+    start = datetime.now()
+    dest = os.path.abspath(dest)
+
+    for (rel_dir,) in conn.execute(VERSION_DIRS_SQL, (version_id,)).fetchall():
+        target = _target_path(dest, rel_dir)
+        if target is not None:
+            os.makedirs(target, exist_ok=True)
+
+    written_files = 0
+    written_chars = 0
+    window = max(1, workers) * 4
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for rel_dir, filename, _, codec, stored, encoding in iter_version_files(conn, version_id):
+            target = _target_path(dest, rel_dir, filename)
+            if target is None:
+                logger.warning(f"Skipping {rel_dir}/{filename}: path is outside {dest}")
+                continue
+            pending.append(executor.submit(_write_file, target, codec, stored, encoding))
+            if len(pending) >= window:
+                written_chars += pending.popleft().result()
+                written_files += 1
+        while pending:
+            written_chars += pending.popleft().result()
+            written_files += 1
+
+    elapsed = (datetime.now() - start).total_seconds()
+    logger.info(f"Checked out {written_files} files into {dest} in {elapsed:.2f}s")
+    return {"files": written_files, "chars": written_chars, "seconds": elapsed}
+
+
+def export_version(conn: sqlite3.Connection, version_id: int, out: BinaryIO,
+                   output_format: str = OUTPUT_MARKDOWN) -> Dict:
+    """
+    Write the flattened document of a stored version.
+
+    Files are streamed from the database and written one at a time, so
+    memory use does not grow with the size of the version, and external
+    blobs are copied in pieces. The output uses the same layout as the
+    flattener, so parsing it gives back the same files.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+        out: Binary stream to write to
+        output_format: OUTPUT_MARKDOWN or OUTPUT_FRAMED
+
+    Returns:
+        Dictionary with the number of files and bytes written
+    """
+    sections = ((_join(rel_dir, filename), language or "", iter_blob_chunks(codec, stored))
+                for rel_dir, filename, language, codec, stored, _
+                in iter_version_files(conn, version_id))
+    return write_output(out, sections, output_format)
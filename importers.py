@@ -0,0 +1,440 @@
+import os
+import re
+import glob
+import logging
+import sqlite3
+import subprocess
+from collections import deque
+from datetime import datetime, timezone
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flattener import (SKIP_TOO_LARGE, SKIP_UNDECODABLE_NAME, SNIFF_BYTES, PathMatcher,
+                       load_settings, log_skipped, read_limits, sniff, undecodable_path)
+from flattener_db import (DEFAULT_ENCODING, UPSERT_FILE_SQL, codec_from_settings, decode_text,
+                          hash_content, insert_version, store_blobs, store_external_blobs,
+                          update_tree_hash, write_external_blob)
+from parse_flattened import iter_flattened_entries
+from snapshot import settings_path_for
+
+logger = logging.getLogger("Importers")
+
+OUTPUT_NAME_PATTERN = re.compile(r'_codebase_v(\d+)\.md$')
+
+# Keeps the head counter ahead of version numbers that are written directly,
+# so the next snapshot cannot reuse an imported number
+BUMP_HEAD_SQL = '''
+INSERT INTO project_heads (project_id, last_version) VALUES (?, ?)
+ON CONFLICT (project_id) DO UPDATE SET last_version = MAX(last_version, excluded.last_version)
+'''
+
+EXISTING_VERSION_SQL = '''
+SELECT v.id, v.pack_id IS NOT NULL OR EXISTS (SELECT 1 FROM files f WHERE f.version_id = v.id)
+FROM versions v
+WHERE v.project_id = ? AND v.version_number = ?
+'''
+
+# (rel_dir, filename, language, encoding, content_hash) of one stored file
+ImportedFile = Tuple[str, str, str, str, str]
+
+
+def find_outputs(root_folder: str) -> List[Tuple[int, str]]:
+    """
+    Find the flattened outputs in a project's .dev/versions folder.
+
+    Args:
+        root_folder: Root directory of the project
+
+    Returns:
+        (version_number, path) pairs sorted by version number
+    """
+    outputs = []
+    for path in glob.glob(os.path.join(root_folder, ".dev", "versions", "*_codebase_v*.md")):
+        match = OUTPUT_NAME_PATTERN.search(os.path.basename(path))
+        if match:
+            outputs.append((int(match.group(1)), path))
+    return sorted(outputs)
+
+
+def _parse_output(job: Tuple[int, str, Dict[str, str]]) -> Tuple[int, str, Optional[List[ImportedFile]],
+                                                                 Dict[str, str], str]:
+    """
+    Parse one flattened output on a worker process.
+
+    A malformed or truncated output does not stop the import: any error
+    reading or parsing it is reported back instead of raised.
+
+    Returns:
+        Tuple of version number, path, parsed files (None if the output
+        could not be read or parsed), their contents by hash and an error
+        message
+    """
+    version_number, path, allowed_extensions = job
+    try:
+        files = []
+        blobs = {}
+        for entry in iter_flattened_entries(path, allowed_extensions):
+            if entry['filename']:
+                content_hash = hash_content(entry['content'])
+                blobs[content_hash] = entry['content']
+                files.append((entry['rel_path'], entry['filename'], entry['language'],
+                              entry['encoding'], content_hash))
+        return version_number, path, files, blobs, ""
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        # ValueError covers undecodable text and a bad framed index
+        return version_number, path, None, {}, f"{type(e).__name__}: {e}"
+
+
+def _iter_parsed_outputs(jobs: List[Tuple[int, str, Dict[str, str]]],
+                         processes: Optional[int] = None) -> Iterator[Tuple]:
+    """
+    Parse outputs on a process pool, yielding results in the order of `jobs`.
+
+    At most two outputs per process are parsed or waiting to be stored at
+    any time, so a slow writer holds back the workers instead of letting
+    parsed outputs accumulate in memory.
+    """
+    if not jobs:
+        return
+    processes = processes or os.cpu_count() or 1
+    window = processes * 2
+    with Pool(processes) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(_parse_output, (job,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def store_imported_version(conn: sqlite3.Connection, project_id: int,
+                           version_number: Optional[int], created_at: str,
+                           files: List[ImportedFile], blobs: Dict[str, str], codec: int,
+                           git_commit: Optional[str] = None,
+                           external_blobs: Optional[Dict[str, Tuple[str, int]]] = None) -> int:
+    """
+    Store the files of an imported version under a given version number.
+
+    The version row is created if it does not exist yet; an existing row
+    keeps its creation time and commit. The files are written in the same
+    transaction as their contents and tree hashes. With no version number,
+    the next one is allocated inside that transaction.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        version_number: Version number to store the files under, or None to
+            allocate the next one
+        created_at: Creation time of the version, 'YYYY-MM-DD HH:MM:SS' in UTC
+        files: Files of the version
+        blobs: Contents by hash; may leave out contents that are already stored
+        codec: Blob codec used for new contents
+        git_commit: Commit the version was imported from
+        external_blobs: Blobs written by write_external_blob, as (blob name,
+            size in bytes) by hash
+
+    Returns:
+        Database ID of the version
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if version_number is None:
+            version_id, version_number = insert_version(conn, project_id)
+            conn.execute("UPDATE versions SET created_at = ?, git_commit = ? WHERE id = ?",
+                         (created_at, git_commit, version_id))
+        else:
+            row = conn.execute(
+                "SELECT id FROM versions WHERE project_id = ? AND version_number = ?",
+                (project_id, version_number)).fetchone()
+            if row is None:
+                version_id = conn.execute(
+                    "INSERT INTO versions (project_id, version_number, created_at, git_commit) "
+                    "VALUES (?, ?, ?, ?)",
+                    (project_id, version_number, created_at, git_commit)).lastrowid
+            else:
+                # An existing version keeps its own creation time and commit
+                version_id = row[0]
+        conn.execute(BUMP_HEAD_SQL, (project_id, version_number))
+
+        store_blobs(conn, blobs, codec)
+        store_external_blobs(conn, external_blobs or {})
+        conn.executemany(UPSERT_FILE_SQL, [
+            (version_id, rel_dir, filename, content_hash, language, encoding)
+            for rel_dir, filename, language, encoding, content_hash in files
+        ])
+        update_tree_hash(conn, version_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version_id
+
+
+def import_history(conn: sqlite3.Connection, project_id: int, root_folder: str,
+                   processes: Optional[int] = None) -> Dict:
+    """
+    Backfill a project's versions from its flattened outputs.
+
+    Every .dev/versions/<name>_codebase_vN.md whose version is missing or
+    has no stored files is parsed on a process pool, while this process is
+    the single database writer. Versions that already have files are left
+    alone.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        root_folder: Root directory of the project
+        processes: Number of parser processes, defaults to the CPU count
+
+    Returns:
+        Dictionary with the numbers of imported, skipped and failed outputs,
+        files and bytes stored and seconds taken
+    """
+    start = datetime.now()
+    settings = load_settings(settings_path_for(root_folder))
+    codec = codec_from_settings(settings)
+
+    jobs = []
+    skipped = 0
+    for version_number, path in find_outputs(root_folder):
+        row = conn.execute(EXISTING_VERSION_SQL, (project_id, version_number)).fetchone()
+        if row is not None and row[1]:
+            skipped += 1
+            continue
+        jobs.append((version_number, path, settings["allowed_extensions"]))
+
+    imported = 0
+    failed = 0
+    total_files = 0
+    total_bytes = 0
+    for version_number, path, files, blobs, error in _iter_parsed_outputs(jobs, processes):
+        if files is None:
+            failed += 1
+            logger.warning(f"Skipped {path}, it could not be parsed: {error}")
+            continue
+        # The output's modification time is the closest thing to when it was taken
+        created_at = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+        store_imported_version(conn, project_id, version_number,
+                               created_at.strftime('%Y-%m-%d %H:%M:%S'), files, blobs, codec)
+        imported += 1
+        total_files += len(files)
+        total_bytes += os.path.getsize(path)
+
+    elapsed = (datetime.now() - start).total_seconds()
+    rate = total_bytes / 1e6 / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Imported {imported} outputs ({total_files} files, {total_bytes / 1e6:.1f} MB) in "
+        f"{elapsed:.2f}s ({rate:.1f} MB/s); {skipped} already stored, {failed} failed")
+    return {"imported": imported, "skipped": skipped, "failed": failed,
+            "files": total_files, "bytes": total_bytes, "seconds": elapsed}
+
+
+class GitCatFile:
+    """
+    A long-lived `git cat-file --batch` process for reading blobs.
+
+    Requests are written one at a time and answered in order, so reading
+    any number of blobs costs one process instead of one per blob.
+    """
+
+    def __init__(self, repo: str):
+        self.process = subprocess.Popen(
+            ["git", "-C", repo, "cat-file", "--batch"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # Sizes are asked for separately, so large blobs are never read
+        self.check_process = subprocess.Popen(
+            ["git", "-C", repo, "cat-file", "--batch-check"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def size(self, sha: str) -> int:
+        """Get the size of a blob in bytes without reading it."""
+        self.check_process.stdin.write(sha.encode('ascii') + b"\n")
+        self.check_process.stdin.flush()
+        header = self.check_process.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(f"Object not found in repository: {sha}")
+        return int(header[2])
+
+    def read(self, sha: str) -> bytes:
+        """Read the contents of a blob."""
+        self.process.stdin.write(sha.encode('ascii') + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(f"Object not found in repository: {sha}")
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # Newline after the contents
+        return data
+
+    def close(self) -> None:
+        for process in (self.process, self.check_process):
+            process.stdin.close()
+            process.wait()
+
+    def __enter__(self) -> "GitCatFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _git(repo: str, *args: str) -> bytes:
+    """Run a git command in a repository and return its output."""
+    return subprocess.run(["git", "-C", repo, *args], check=True,
+                          stdout=subprocess.PIPE).stdout
+
+
+def _read_git_blob(cat_file: GitCatFile, sha: str, limits: Dict[str, int]) -> Dict:
+    """
+    Read a git blob the way a snapshot reads a file.
+
+    Blobs over max_file_size are skipped on their size alone, others are
+    sniffed before they are decoded, and blobs over external_blob_size go
+    to the external blob store, so an import stores the same files with
+    the same hashes as a snapshot of the same tree.
+
+    Returns:
+        Dictionary with a 'skipped' reason, or 'hash' and 'encoding' plus
+        either 'content' or the 'external' blob name and its 'size'
+    """
+    size = cat_file.size(sha)
+    if limits["max_file_size"] and size > limits["max_file_size"]:
+        return {'skipped': SKIP_TOO_LARGE}
+    data = cat_file.read(sha)
+    reason = sniff(data[:SNIFF_BYTES], limits)
+    if reason is not None:
+        return {'skipped': reason}
+    if limits["external_blob_size"] and size > limits["external_blob_size"]:
+        stored = write_external_blob(data)
+        if stored is not None:
+            return {'hash': stored[0], 'encoding': DEFAULT_ENCODING,
+                    'external': stored[1], 'size': size}
+    content, encoding = decode_text(data)
+    return {'hash': hash_content(content), 'encoding': encoding, 'content': content}
+
+
+def iter_commits(repo: str, rev_range: str = "HEAD") -> Iterator[Tuple[str, int]]:
+    """
+    List the commits of a revision range, oldest first.
+
+    Args:
+        repo: Path to the git repository
+        rev_range: Revision range, e.g. 'HEAD' or 'v1.0..main'
+
+    Yields:
+        (commit sha, commit timestamp) pairs
+    """
+    output = _git(repo, "rev-list", "--reverse", "--topo-order", "--timestamp", rev_range)
+    for line in output.decode('ascii').splitlines():
+        timestamp, sha = line.split()
+        yield sha, int(timestamp)
+
+
+def iter_commit_blobs(repo: str, commit: str) -> Iterator[Tuple[str, str]]:
+    """
+    List the files of a commit.
+
+    Args:
+        repo: Path to the git repository
+        commit: Commit sha
+
+    Yields:
+        (path, blob sha) pairs; submodules and symlinks are left out, and
+        bytes of paths that are not valid UTF-8 are kept as surrogate escapes
+    """
+    output = _git(repo, "ls-tree", "-r", "-z", "--full-tree", commit)
+    for record in output.split(b"\0"):
+        if not record:
+            continue
+        info, _, path = record.partition(b"\t")
+        mode, kind, sha = info.split()
+        if kind == b"blob" and mode != b"120000":
+            yield path.decode('utf-8', errors='surrogateescape'), sha.decode('ascii')
+
+
+def import_git(conn: sqlite3.Connection, project_id: int, repo: str,
+               rev_range: str = "HEAD") -> Dict:
+    """
+    Store every commit of a git revision range as a version.
+
+    Paths go through the project's allowed_extensions and ignored_files
+    rules, and paths that are not valid UTF-8 are left out and logged once.
+    Blobs are checked against the same size, binary and minified limits as
+    a snapshot, and large ones go to the external blob store. Blob contents
+    are streamed through one `git cat-file --batch`
+    process, and each blob is read only the first time it appears, so
+    unchanged files cost nothing in later commits. Commits that were
+    imported before are skipped.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        repo: Path to the git repository (the project root)
+        rev_range: Revision range to import
+
+    Returns:
+        Dictionary with the numbers of imported and skipped commits, blobs
+        read and seconds taken
+    """
+    start = datetime.now()
+    settings = load_settings(settings_path_for(repo))
+    codec = codec_from_settings(settings)
+    allowed_extensions = settings["allowed_extensions"]
+    matcher = PathMatcher(settings)
+    limits = read_limits(settings)
+
+    imported_commits = {row[0] for row in conn.execute(
+        "SELECT git_commit FROM versions WHERE project_id = ? AND git_commit IS NOT NULL",
+        (project_id,))}
+
+    # Git blob sha to what _read_git_blob made of it, for blobs already read
+    known: Dict[str, Dict] = {}
+    # Paths left out of any commit, with the reason
+    left_out: Dict[str, str] = {}
+    imported = 0
+    skipped = 0
+    with GitCatFile(repo) as cat_file:
+        for commit, timestamp in iter_commits(repo, rev_range):
+            if commit in imported_commits:
+                skipped += 1
+                continue
+
+            files = []
+            blobs = {}
+            external_blobs = {}
+            for path, sha in iter_commit_blobs(repo, commit):
+                if not matcher.includes(path):
+                    continue
+                printable = undecodable_path(path)
+                if printable is not None:
+                    left_out[printable] = SKIP_UNDECODABLE_NAME
+                    continue
+                if sha not in known:
+                    blob = known[sha] = _read_git_blob(cat_file, sha, limits)
+                    if 'external' in blob:
+                        external_blobs[blob['hash']] = (blob['external'], blob['size'])
+                    elif 'content' in blob:
+                        blobs[blob['hash']] = blob.pop('content')
+                blob = known[sha]
+                if 'skipped' in blob:
+                    left_out[path] = blob['skipped']
+                    continue
+                content_hash, encoding = blob['hash'], blob['encoding']
+                rel_dir, _, filename = path.rpartition('/')
+                language = allowed_extensions.get(os.path.splitext(filename)[1], "")
+                files.append((rel_dir, filename, language, encoding, content_hash))
+
+            created_at = datetime.fromtimestamp(timestamp, timezone.utc)
+            store_imported_version(conn, project_id, None,
+                                   created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                                   files, blobs, codec, git_commit=commit,
+                                   external_blobs=external_blobs)
+            imported += 1
+
+    log_skipped(sorted(left_out.items()))
+    elapsed = (datetime.now() - start).total_seconds()
+    rate = imported / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Imported {imported} commits ({len(known)} blobs read) in {elapsed:.2f}s "
+                f"({rate:.1f} commits/s); {skipped} already imported")
+    return {"imported": imported, "skipped": skipped, "blobs": len(known), "seconds": elapsed}
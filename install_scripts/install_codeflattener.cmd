@@ -23,6 +23,19 @@ powershell -Command "& {$releasesData = Get-Content -Path '%installDir%\releases
 powershell -Command "& {$releasesData = Get-Content -Path '%installDir%\releases.json' | ConvertFrom-Json; $currentRelease = $releasesData.releases | Where-Object { $_.version -eq $releasesData.current_version }; Invoke-WebRequest -Uri $currentRelease.downloads.setup -OutFile '%installDir%\setup_flattener_vcs.py'}"
 powershell -Command "& {$releasesData = Get-Content -Path '%installDir%\releases.json' | ConvertFrom-Json; $currentRelease = $releasesData.releases | Where-Object { $_.version -eq $releasesData.current_version }; Invoke-WebRequest -Uri $currentRelease.downloads.updater -OutFile '%installDir%\updater.py'}"
 
+:: Download the Python modules used by the setup script
+echo Downloading module files...
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/flattener.py' -OutFile '%installDir%\flattener.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/parse_flattened.py' -OutFile '%installDir%\parse_flattened.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/flattener_db.py' -OutFile '%installDir%\flattener_db.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/fltn.py' -OutFile '%installDir%\fltn.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/search.py' -OutFile '%installDir%\search.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/snapshot.py' -OutFile '%installDir%\snapshot.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/history.py' -OutFile '%installDir%\history.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/retention.py' -OutFile '%installDir%\retention.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/packfile.py' -OutFile '%installDir%\packfile.py'}"
+powershell -Command "& {Invoke-WebRequest -Uri '%REPO_URL%/raw/main/importers.py' -OutFile '%installDir%\importers.py'}"
+
 :: Create templates directory
 mkdir "%installDir%\templates" 2>nul
 
@@ -34,7 +47,7 @@ powershell -Command "& {try { Invoke-WebRequest -Uri '%REPO_URL%/raw/main/templa
 
 :: Create a batch file to run the Python script
 echo @echo off > "%installDir%\fltn.bat"
-echo python "%installDir%\setup_flattener_vcs.py" %%* >> "%installDir%\fltn.bat"
+echo python "%installDir%\fltn.py" %%* >> "%installDir%\fltn.bat"
 
 :: Add the installation directory to the user's PATH
 setx PATH "%PATH%;%installDir%"
@@ -43,3 +56,11 @@ echo Installation completed. CodeFlattener v%currentVersion% is installed in: %i
 echo The 'fltn' command has been added to your PATH.
 echo Please restart your command prompt to use the new command.
 echo Usage: fltn [path_to_codebase]
+echo        fltn search ^<query^> [--project NAME] [--version N]
+echo        fltn diff ^<project^> ^<old^> ^<new^> [--name-status]
+echo        fltn checkout ^<project^> ^<version^> ^<dest^>
+echo        fltn export ^<project^> ^<version^> [-o FILE]
+echo        fltn gc [--dry-run]
+echo        fltn pack ^<project^> ^<first^> ^<last^>
+echo        fltn import-history ^<project^>
+echo        fltn import-git ^<repo^> [rev-range]
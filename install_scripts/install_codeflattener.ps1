@@ -37,6 +37,28 @@ foreach ($key in $filesToDownload.Keys) {
     Invoke-WebRequest -Uri $url -OutFile $destination
 }
 
+# Download the Python modules used by the setup script
+$moduleFiles = @(
+    "flattener.py",
+    "parse_flattened.py",
+    "flattener_db.py",
+    "fltn.py",
+    "search.py",
+    "snapshot.py",
+    "history.py",
+    "retention.py",
+    "packfile.py",
+    "importers.py"
+)
+
+foreach ($moduleFile in $moduleFiles) {
+    $url = "$REPO_URL/raw/main/$moduleFile"
+    $destination = Join-Path $installDir $moduleFile
+
+    Write-Host "Downloading module $moduleFile..."
+    Invoke-WebRequest -Uri $url -OutFile $destination
+}
+
 # Create templates directory
 $templatesDir = Join-Path $installDir "templates"
 New-Item -ItemType Directory -Force -Path $templatesDir | Out-Null
@@ -64,10 +86,7 @@ foreach ($templateFile in $templateFiles) {
 # Add the function to the PowerShell profile
 $functionContent = @"
 function fltn {
-    param(
-        [string]`$path = "."
-    )
-    python "$installDir\setup_flattener_vcs.py" `$path
+    python "$installDir\fltn.py" @args
 }
 "@
 
@@ -81,3 +100,11 @@ Write-Host "Installation completed. CodeFlattener v$currentVersion is installed
 Write-Host "The 'fltn' command has been added to your PowerShell profile."
 Write-Host "Please restart your PowerShell session or run '. $profilePath' to use the new command."
 Write-Host "Usage: fltn [path_to_codebase]"
+Write-Host "       fltn search <query> [--project NAME] [--version N]"
+Write-Host "       fltn diff <project> <old> <new> [--name-status]"
+Write-Host "       fltn checkout <project> <version> <dest>"
+Write-Host "       fltn export <project> <version> [-o FILE]"
+Write-Host "       fltn gc [--dry-run]"
+Write-Host "       fltn pack <project> <first> <last>"
+Write-Host "       fltn import-history <project>"
+Write-Host "       fltn import-git <repo> [rev-range]"
@@ -41,6 +41,28 @@ for key in "${!files_to_download[@]}"; do
     wget -O "$destination" "$url" || curl -o "$destination" "$url"
 done
 
+# Download the Python modules used by the setup script
+module_files=(
+    "flattener.py"
+    "parse_flattened.py"
+    "flattener_db.py"
+    "fltn.py"
+    "search.py"
+    "snapshot.py"
+    "history.py"
+    "retention.py"
+    "packfile.py"
+    "importers.py"
+)
+
+for module_file in "${module_files[@]}"; do
+    url="$REPO_URL/raw/main/$module_file"
+    destination="$install_dir/$module_file"
+
+    echo "Downloading module $module_file..."
+    wget -O "$destination" "$url" || curl -o "$destination" "$url"
+done
+
 # Create templates directory
 templates_dir="$install_dir/templates"
 mkdir -p "$templates_dir"
@@ -61,7 +83,7 @@ for template_file in "${template_files[@]}"; do
 done
 
 # Create an alias to run the Python script
-alias_line="alias fltn='python $install_dir/setup_flattener_vcs.py'"
+alias_line="alias fltn='python $install_dir/fltn.py'"
 
 # Determine which shell configuration file to use
 if [[ -n "$BASH_VERSION" ]]; then
@@ -82,3 +104,11 @@ echo "Installation completed. CodeFlattener v$current_version is installed in: $
 echo "The 'fltn' alias has been added to your $config_file file."
 echo "Please restart your terminal or run 'source $config_file' to use the new alias."
 echo "Usage: fltn [path_to_codebase]"
+echo "       fltn search <query> [--project NAME] [--version N]"
+echo "       fltn diff <project> <old> <new> [--name-status]"
+echo "       fltn checkout <project> <version> <dest>"
+echo "       fltn export <project> <version> [-o FILE]"
+echo "       fltn gc [--dry-run]"
+echo "       fltn pack <project> <first> <last>"
+echo "       fltn import-history <project>"
+echo "       fltn import-git <repo> [rev-range]"
@@ -0,0 +1,274 @@
+import os
+import json
+import zlib
+import bisect
+import struct
+import logging
+import sqlite3
+import tempfile
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flattener_db import (CODEC_ZLIB, DEFAULT_COMPRESSION_LEVEL, PACKS_DIR,
+                          decode_blob, head_version, iter_blob_chunks)
+
+logger = logging.getLogger("Packfile")
+
+# A pack is the magic, the zlib-compressed contents of every distinct file
+# of its versions back to back, the compressed index and a fixed-size footer
+# holding the index position
+PACK_MAGIC = b"FLTNPACK1\n"
+FOOTER = struct.Struct("<QQ8s")
+FOOTER_MAGIC = b"FLTNIDX1"
+
+# Number of packs kept open by readers
+OPEN_PACKS = 16
+
+PACK_FILES_SQL = '''
+SELECT v.version_number, f.rel_path, f.filename, f.language, f.content_hash,
+       b.codec, b.content, f.encoding
+FROM versions v
+JOIN files f ON f.version_id = v.id
+JOIN blobs b ON b.hash = f.content_hash
+WHERE v.id = ?
+ORDER BY f.rel_path, f.filename
+'''
+
+VERSION_PACK_SQL = '''
+SELECT p.path, v.version_number FROM versions v
+JOIN packs p ON p.id = v.pack_id
+WHERE v.id = ?
+'''
+
+
+class PackFile:
+    """
+    Read access to a pack archive.
+
+    The index is loaded once; after that reading any file of a packed
+    version is one seek and one decompression.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f"Not a pack file: {path}")
+            f.seek(-FOOTER.size, os.SEEK_END)
+            index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != FOOTER_MAGIC:
+                raise ValueError(f"Pack file is truncated: {path}")
+            f.seek(index_offset)
+            index = json.loads(zlib.decompress(f.read(index_length)))
+
+        # (version_number, rel_dir, filename, language, hash, offset, length,
+        # encoding), sorted by version, directory and file name; packs written
+        # before encodings were recorded have no encoding
+        self.entries: List[Tuple] = [tuple(entry) + (None,) * (8 - len(entry)) for entry in index]
+        self.keys = [entry[:3] for entry in self.entries]
+        self.by_hash = {entry[4]: (entry[5], entry[6]) for entry in self.entries}
+
+    def _range(self, version_number: int, rel_dir: Optional[str] = None) -> range:
+        """Index positions of a version's entries, or of one directory of it."""
+        if rel_dir is None:
+            low = bisect.bisect_left(self.keys, (version_number,))
+            high = bisect.bisect_left(self.keys, (version_number + 1,))
+        else:
+            low = bisect.bisect_left(self.keys, (version_number, rel_dir))
+            high = bisect.bisect_left(self.keys, (version_number, rel_dir + "\0"))
+        return range(low, high)
+
+    def read_stored(self, offset: int, length: int) -> bytes:
+        """Read the compressed contents stored at an offset."""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read(self, content_hash: str) -> Optional[str]:
+        """Read contents by hash, or None if they are not in this pack."""
+        location = self.by_hash.get(content_hash)
+        if location is None:
+            return None
+        return decode_blob(CODEC_ZLIB, self.read_stored(*location))
+
+    def version_files(self, version_number: int) -> Iterator[Tuple[str, str, str, int, bytes,
+                                                                  Optional[str]]]:
+        """
+        Stream the files of a packed version in flattened output order.
+
+        Yields:
+            Tuples of (rel_dir, filename, language, codec, stored content,
+            encoding), like history.iter_version_files
+        """
+        with open(self.path, 'rb') as f:
+            for i in self._range(version_number):
+                _, rel_dir, filename, language, _, offset, length, encoding = self.entries[i]
+                f.seek(offset)
+                yield rel_dir, filename, language, CODEC_ZLIB, f.read(length), encoding
+
+    def dir_files(self, version_number: int, rel_dir: str) -> Dict[str, str]:
+        """Map the file names of one directory of a packed version to their hashes."""
+        return {self.entries[i][2]: self.entries[i][4]
+                for i in self._range(version_number, rel_dir)}
+
+
+@lru_cache(maxsize=OPEN_PACKS)
+def open_pack(path: str) -> PackFile:
+    """Open a pack, reusing its loaded index if it was opened recently."""
+    return PackFile(path)
+
+
+def version_pack(conn: sqlite3.Connection, version_id: int) -> Optional[Tuple[PackFile, int]]:
+    """
+    Find the pack a version is stored in.
+
+    Args:
+        conn: Open database connection
+        version_id: Database ID of the version
+
+    Returns:
+        Tuple of the open pack and the version number, or None if the
+        version is stored in the database
+    """
+    row = conn.execute(VERSION_PACK_SQL, (version_id,)).fetchone()
+    if row is None:
+        return None
+    return open_pack(row[0]), row[1]
+
+
+def _write_pack(conn: sqlite3.Connection, version_ids: List[int], path: str) -> int:
+    """Write the files of versions to a new pack file, returning the number of entries."""
+    written = {}
+    index = []
+    with open(path, 'wb') as out:
+        out.write(PACK_MAGIC)
+        for version_id in version_ids:
+            for number, rel_dir, filename, language, content_hash, codec, stored, encoding in \
+                    conn.execute(PACK_FILES_SQL, (version_id,)):
+                if content_hash not in written:
+                    offset = out.tell()
+                    if codec == CODEC_ZLIB:
+                        # Contents already compressed in the database are copied as they are
+                        out.write(stored)
+                    else:
+                        compressor = zlib.compressobj(DEFAULT_COMPRESSION_LEVEL)
+                        for chunk in iter_blob_chunks(codec, stored):
+                            out.write(compressor.compress(chunk.encode('utf-8')))
+                        out.write(compressor.flush())
+                    written[content_hash] = (offset, out.tell() - offset)
+                index.append((number, rel_dir, filename, language or "", content_hash,
+                              *written[content_hash], encoding))
+
+        index.sort(key=lambda entry: entry[:3])
+        index_data = zlib.compress(json.dumps(index).encode('utf-8'))
+        index_offset = out.tell()
+        out.write(index_data)
+        out.write(FOOTER.pack(index_offset, len(index_data), FOOTER_MAGIC))
+        out.flush()
+        os.fsync(out.fileno())
+    return len(index)
+
+
+def pack_versions(conn: sqlite3.Connection, project_id: int, first: int, last: int,
+                  pack_dir: Optional[str] = None) -> Optional[Dict]:
+    """
+    Move a range of a project's versions from the database into a pack file.
+
+    The versions keep their rows and directory hashes, so they still show up
+    in history and diffs, but their file rows are replaced by the pack's
+    index. The project's latest version is never packed. Contents that no
+    other version uses are reclaimed by the next `fltn gc`.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        first: First version number to pack
+        last: Last version number to pack
+        pack_dir: Folder for the pack file, defaults to ~/.fltn_data/packs/<project>
+
+    Returns:
+        Dictionary with the pack path, packed version numbers, entries and
+        size in bytes, or None if there was nothing to pack
+
+    Raises:
+        RuntimeError: If another process packed some of the versions meanwhile
+    """
+    start = datetime.now()
+    name = conn.execute("SELECT name FROM projects WHERE id = ?", (project_id,)).fetchone()[0]
+    head = head_version(conn, project_id)
+    rows = conn.execute(
+        "SELECT id, version_number FROM versions WHERE project_id = ? "
+        "AND version_number BETWEEN ? AND ? AND pack_id IS NULL ORDER BY version_number",
+        (project_id, first, last)).fetchall()
+    rows = [(version_id, number) for version_id, number in rows
+            if head is None or version_id != head[0]]
+    if not rows:
+        return None
+
+    pack_dir = pack_dir or os.path.join(PACKS_DIR, name)
+    os.makedirs(pack_dir, exist_ok=True)
+    numbers = [number for _, number in rows]
+    # A unique temporary name, so concurrent packers never write the same file
+    fd, temp_path = tempfile.mkstemp(
+        dir=pack_dir, prefix=f".{name}_v{numbers[0]}-{numbers[-1]}_", suffix=".pack.tmp")
+    os.close(fd)
+    entries = _write_pack(conn, [version_id for version_id, _ in rows], temp_path)
+
+    path = None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        pack_id = conn.execute(
+            "INSERT INTO packs (project_id, path, first_version, last_version) VALUES (?, '', ?, ?)",
+            (project_id, numbers[0], numbers[-1])).lastrowid
+        path = os.path.join(pack_dir, f"{name}_pack{pack_id}_v{numbers[0]}-{numbers[-1]}.pack")
+        conn.execute("UPDATE packs SET path = ? WHERE id = ?", (path, pack_id))
+        updated = conn.executemany(
+            "UPDATE versions SET pack_id = ? WHERE id = ? AND pack_id IS NULL",
+            [(pack_id, version_id) for version_id, _ in rows]).rowcount
+        if updated != len(rows):
+            raise RuntimeError(
+                f"Versions {numbers[0]}-{numbers[-1]} of {name} were packed by another process")
+        conn.executemany("DELETE FROM files WHERE version_id = ?",
+                         [(version_id,) for version_id, _ in rows])
+        os.replace(temp_path, path)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for leftover in (temp_path, path):
+            if leftover and os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+
+    size = os.path.getsize(path)
+    elapsed = (datetime.now() - start).total_seconds()
+    logger.info(f"Packed {len(numbers)} versions of {name} ({entries} files, "
+                f"{size} bytes) into {path} in {elapsed:.2f}s")
+    return {"path": path, "versions": numbers, "entries": entries, "bytes": size}
+
+
+def delete_empty_packs(conn: sqlite3.Connection) -> int:
+    """
+    Delete packs whose versions have all been pruned, with their files.
+
+    Args:
+        conn: Open database connection
+
+    Returns:
+        Number of packs deleted
+    """
+    rows = conn.execute('''
+    SELECT id, path FROM packs p
+    WHERE NOT EXISTS (SELECT 1 FROM versions v WHERE v.pack_id = p.id)
+    ''').fetchall()
+    for pack_id, path in rows:
+        conn.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
+        conn.commit()
+        open_pack.cache_clear()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {e}")
+    return len(rows)
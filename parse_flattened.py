@@ -3,128 +3,381 @@ import sys
 import sqlite3
 import re
 import json
+import time
 import logging
 from datetime import datetime
+from flattener import (FRAMED_INDEX_END, FRAMED_INDEX_START, FRAMED_MAGIC,
+                       FRAMED_TRAILER_SIZE)
+from flattener_db import (CODEC_RAW, UPSERT_FILE_SQL, codec_from_settings, decode_text,
+                          get_connection, hash_content, store_blobs, update_tree_hash)
 
 # Configure logging
 DATABASE_DIR = os.path.join(os.path.expanduser("~"), ".fltn_data")
 LOGS_DIR = os.path.join(DATABASE_DIR, "logs")
-os.makedirs(LOGS_DIR, exist_ok=True)
-
-log_file = os.path.join(
-    LOGS_DIR, f"parser_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+
 logger = logging.getLogger("Parser")
 
+# Flattened markdown layout: "# path/to/file.ext", "```language", code, "```".
+# Matched on raw bytes, so each file is decoded on its own
+HEADER_PATTERN = re.compile(rb'#\s+(.+?)\s*$')
+OPEN_FENCE_PATTERN = re.compile(rb'```([a-zA-Z0-9]+)?\s*$')
+
+# Framed layout: the opening fence carries the byte length of the contents
+FRAMED_FENCE_PATTERN = re.compile(rb'```([a-zA-Z0-9]*) length=(\d+)$')
+FRAMED_TRAILER_PATTERN = re.compile(rb'<!-- fltn-index-offset (\d+) -->\n$')
+
+# Number of rows sent to the database per executemany call
+DEFAULT_BATCH_SIZE = 500
+
+# Parser states
+OUTSIDE = 0
+AFTER_HEADER = 1
+IN_CODE = 2
+
+
+def configure_logging():
+    """Send log output to the central logs folder and the console."""
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    log_file = os.path.join(
+        LOGS_DIR, f"parser_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler()
+        ]
+    )
 
-def parse_flattened_file(file_path, project_id, version_id):
+
+def load_appsettings(appsettings_path):
     """
-    Parse a flattened markdown file and store in database.
+    Load the settings used by the parser from appsettings.json.
 
     Args:
-        file_path: Path to the flattened markdown file
-        project_id: ID of the project in the database
-        version_id: ID of the version in the database
+        appsettings_path: Path to appsettings.json
+
+    Returns:
+        Dictionary of settings, empty if the file cannot be read
     """
-    # Load file extensions from appsettings.json
-    appsettings_path = os.path.join(os.path.dirname(
-        os.path.abspath(__file__)), "appsettings.json")
     try:
         with open(appsettings_path, 'r') as f:
-            settings = json.load(f)
-
-        allowed_extensions = settings.get("allowed_extensions", {})
+            return json.load(f)
     except Exception as e:
         logger.error(f"Failed to load appsettings.json: {e}")
-        allowed_extensions = {}
+        return {}
 
-    # Read the file
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-    except Exception as e:
-        logger.error(f"Failed to read flattened file: {e}")
+
+def _make_entry(header_path, language, data, allowed_extensions):
+    """
+    Build a file entry from the raw header path and contents of a section.
+
+    The path and contents are decoded separately with decode_text, so a
+    file in another encoding only affects its own entry.
+    """
+    if isinstance(header_path, bytes):
+        header_path = decode_text(header_path)[0]
+    rel_path = os.path.dirname(header_path)
+    filename = os.path.basename(header_path)
+
+    # Determine language from file extension if not specified
+    if not language:
+        ext = os.path.splitext(filename)[1]
+        language = allowed_extensions.get(ext, "")
+
+    content, encoding = decode_text(data)
+
+    return {
+        'rel_path': rel_path,
+        'filename': filename,
+        'content': content,
+        'language': language,
+        'encoding': encoding
+    }
+
+
+def _code_block(code_lines):
+    """Join the lines of a markdown code block into the file's contents."""
+    # The newline before the closing fence belongs to the layout, not the
+    # file; in a document saved with CRLF line endings that is b'\r\n'
+    data = b''.join(code_lines)
+    if data.endswith(b'\r\n'):
+        return data[:-2]
+    return data[:-1] if data.endswith(b'\n') else data
+
+
+def is_framed(file_path):
+    """Check whether a flattened file uses the framed layout."""
+    with open(file_path, 'rb') as f:
+        return f.read(len(FRAMED_MAGIC)) == FRAMED_MAGIC
+
+
+def read_framed_index(file_path):
+    """
+    Read the index at the end of a framed flattened file.
+
+    Args:
+        file_path: Path to the flattened file
+
+    Returns:
+        List of dictionaries with path, language, offset, length and hash,
+        in document order
+
+    Raises:
+        ValueError: If the file has no complete index
+    """
+    with open(file_path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size < FRAMED_TRAILER_SIZE:
+            raise ValueError(f"No index in {file_path}")
+        f.seek(size - FRAMED_TRAILER_SIZE)
+        trailer = FRAMED_TRAILER_PATTERN.match(f.read(FRAMED_TRAILER_SIZE))
+        if trailer is None:
+            raise ValueError(f"No index in {file_path}")
+        f.seek(int(trailer.group(1)))
+        index = f.read(size - FRAMED_TRAILER_SIZE - int(trailer.group(1)))
+
+    if not (index.startswith(FRAMED_INDEX_START) and index.endswith(FRAMED_INDEX_END)):
+        raise ValueError(f"Damaged index in {file_path}")
+    lines = index[len(FRAMED_INDEX_START):-len(FRAMED_INDEX_END)].splitlines()
+    return [json.loads(line) for line in lines]
+
+
+def read_framed_entries(file_path, index, allowed_extensions):
+    """
+    Read files of a framed flattened file by their index entries.
+
+    Each file costs one seek and one read, so any subset of the index, e.g.
+    one slice per worker process, can be read on its own.
+
+    Args:
+        file_path: Path to the flattened file
+        index: Entries from read_framed_index
+        allowed_extensions: Dictionary mapping file extensions to language identifiers
+
+    Yields:
+        Dictionaries with rel_path, filename, content, language and encoding
+    """
+    with open(file_path, 'rb') as f:
+        for item in index:
+            f.seek(item['offset'])
+            data = f.read(item['length'])
+            if len(data) != item['length']:
+                logger.warning(f"Truncated contents for {item['path']} in {file_path}")
+                continue
+            yield _make_entry(item['path'], item['language'], data, allowed_extensions)
+
+
+def _scan_framed_entries(file_path, allowed_extensions):
+    """Read a framed flattened file front to back, for files whose index is missing."""
+    with open(file_path, 'rb') as f:
+        f.readline()
+        while True:
+            header = HEADER_PATTERN.match(f.readline().rstrip(b'\r\n'))
+            if header is None:
+                return
+            fence = FRAMED_FENCE_PATTERN.match(f.readline().rstrip(b'\r\n'))
+            if fence is None:
+                return
+            data = f.read(int(fence.group(2)))
+            yield _make_entry(header.group(1), fence.group(1).decode('ascii'), data,
+                              allowed_extensions)
+            f.readline()  # Newline before the closing fence
+            f.readline()  # Closing fence
+            f.readline()  # Blank line between sections
+
+
+def iter_flattened_entries(file_path, allowed_extensions):
+    """
+    Stream the file entries of a flattened markdown file.
+
+    The document is read as bytes, line by line with a small state machine,
+    so only the file currently being parsed is held in memory and a file
+    that is not UTF-8 cannot stop the rest of the document from parsing.
+    Framed documents are read through their index instead, or by their
+    length fields if the index is missing.
+
+    Args:
+        file_path: Path to the flattened markdown file
+        allowed_extensions: Dictionary mapping file extensions to language identifiers
+
+    Yields:
+        Dictionaries with rel_path, filename, content, language and the
+        encoding the content was decoded from
+    """
+    if is_framed(file_path):
+        try:
+            index = read_framed_index(file_path)
+        except ValueError as e:
+            logger.warning(f"{e}; reading sections in order")
+            yield from _scan_framed_entries(file_path, allowed_extensions)
+        else:
+            yield from read_framed_entries(file_path, index, allowed_extensions)
         return
 
-    # Parse the markdown file to extract code blocks
-    pattern = r'#\s+(.+?)(?:\n```([a-zA-Z0-9]+)?\n([\s\S]+?)```|$)'
-    matches = re.findall(pattern, content)
+    state = OUTSIDE
+    header_path = None
+    language = None
+    code_lines = []
 
-    logger.info(f"Found {len(matches)} file entries in flattened output")
+    with open(file_path, 'rb') as f:
+        for line in f:
+            stripped = line.rstrip(b'\r\n')
 
-    # Connect to database
-    db_path = os.path.join(DATABASE_DIR, "flattener.db")
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+            if state == IN_CODE:
+                if stripped == b'```':
+                    yield _make_entry(header_path, language, _code_block(code_lines),
+                                      allowed_extensions)
+                    code_lines = []
+                    state = OUTSIDE
+                else:
+                    code_lines.append(line)
+                continue
+
+            if state == AFTER_HEADER:
+                fence = OPEN_FENCE_PATTERN.match(stripped)
+                if fence:
+                    language = (fence.group(1) or b"").decode('ascii')
+                    state = IN_CODE
+                    continue
+                state = OUTSIDE
+
+            header = HEADER_PATTERN.match(stripped)
+            if header:
+                header_path = header.group(1)
+                state = AFTER_HEADER
+
+    if state == IN_CODE:
+        logger.warning(f"Unterminated code block for {header_path} at end of file")
+        yield _make_entry(header_path, language, _code_block(code_lines), allowed_extensions)
+
+
+def store_entries(conn, version_id, entries, batch_size=DEFAULT_BATCH_SIZE,
+                  codec=CODEC_RAW):
+    """
+    Store parsed file entries for a version.
+
+    All rows are written with batched UPSERTs inside a single transaction,
+    so re-parsing a version updates rows in place without extra round trips.
+    File contents go to the content-addressed blobs table, so contents that
+    are already stored from an earlier version are not written again.
+
+    Args:
+        conn: Open database connection
+        version_id: ID of the version in the database
+        entries: Iterable of file entries from iter_flattened_entries
+        batch_size: Number of rows per executemany call
+        codec: Blob codec used for new contents
+
+    Returns:
+        Number of files stored
+    """
+    start = time.perf_counter()
+    successful_files = 0
+    new_blobs = 0
+    batch = []
+    batch_blobs = {}
 
-        # Store each file
-        successful_files = 0
-        for file_path_match, language, code in matches:
-            file_path_clean = file_path_match.strip()
-            rel_path = os.path.dirname(file_path_clean)
-            filename = os.path.basename(file_path_clean)
+    def flush():
+        nonlocal successful_files, new_blobs, batch, batch_blobs
+        new_blobs += store_blobs(conn, batch_blobs, codec)
+        conn.executemany(UPSERT_FILE_SQL, batch)
+        successful_files += len(batch)
+        batch = []
+        batch_blobs = {}
 
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for entry in entries:
             # Skip empty or invalid entries
-            if not filename:
+            if not entry['filename']:
                 continue
 
-            # Determine language from file extension if not specified
-            if not language:
-                ext = os.path.splitext(filename)[1]
-                language = allowed_extensions.get(ext, "")
-
-            # Store in database
-            try:
-                cursor.execute(
-                    "INSERT INTO files (version_id, rel_path, filename, content, language) VALUES (?, ?, ?, ?, ?)",
-                    (version_id, rel_path, filename, code.strip(), language)
-                )
-                successful_files += 1
-            except sqlite3.IntegrityError:
-                # Update if already exists
-                cursor.execute(
-                    "UPDATE files SET content = ?, language = ? WHERE version_id = ? AND rel_path = ? AND filename = ?",
-                    (code.strip(), language, version_id, rel_path, filename)
-                )
-                successful_files += 1
-            except Exception as e:
-                logger.error(f"Error storing file {rel_path}/{filename}: {e}")
+            content_hash = hash_content(entry['content'])
+            batch_blobs[content_hash] = entry['content']
+            batch.append((version_id, entry['rel_path'], entry['filename'],
+                          content_hash, entry['language'], entry.get('encoding')))
+            if len(batch) >= batch_size:
+                flush()
 
+        if batch:
+            flush()
+        update_tree_hash(conn, version_id)
         conn.commit()
-        conn.close()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    rate = successful_files / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Stored {successful_files} files ({new_blobs} new contents) in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+    return successful_files
+
+
+def parse_flattened_file(file_path, project_id, version_id, appsettings_path=None,
+                         batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Parse a flattened markdown file and store in database.
+
+    Args:
+        file_path: Path to the flattened markdown file
+        project_id: ID of the project in the database
+        version_id: ID of the version in the database
+        appsettings_path: Path to appsettings.json, defaults to the one next to this script
+        batch_size: Number of rows per executemany call
+    """
+    # Load file extensions from appsettings.json
+    if appsettings_path is None:
+        appsettings_path = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "appsettings.json")
+    settings = load_appsettings(appsettings_path)
+    allowed_extensions = settings.get("allowed_extensions", {})
+    codec = codec_from_settings(settings)
+
+    # Connect to database
+    try:
+        conn = get_connection()
+
+        entries = iter_flattened_entries(file_path, allowed_extensions)
+        successful_files = store_entries(
+            conn, version_id, entries, batch_size, codec)
 
         logger.info(
             f"Successfully processed {successful_files} files from {file_path}")
+    except OSError as e:
+        logger.error(f"Failed to read flattened file: {e}")
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
     except Exception as e:
         logger.error(f"Failed to process flattened file: {e}")
 
 
-def main():
-    """Main entry point for the parser script."""
+def main(appsettings_path=None):
+    """
+    Main entry point for the parser script.
+
+    Args:
+        appsettings_path: Path to appsettings.json, defaults to the one next to this script
+    """
+    configure_logging()
+
     if len(sys.argv) < 4:
         logger.error(
-            "Usage: python parse_flattened.py <flattened_file_path> <project_id> <version_id>")
+            "Usage: python parse_flattened.py <flattened_file_path> <project_id> <version_id> [batch_size]")
         sys.exit(1)
 
     try:
         flattened_file = sys.argv[1]
         project_id = int(sys.argv[2])
         version_id = int(sys.argv[3])
+        batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_BATCH_SIZE
 
         logger.info(f"Parsing file: {flattened_file}")
         logger.info(f"Project ID: {project_id}, Version ID: {version_id}")
 
-        parse_flattened_file(flattened_file, project_id, version_id)
+        parse_flattened_file(flattened_file, project_id,
+                             version_id, appsettings_path, batch_size)
     except Exception as e:
         logger.error(f"Failed to execute parser: {e}")
         sys.exit(1)
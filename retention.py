@@ -0,0 +1,393 @@
+import os
+import re
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from flattener import load_settings
+from flattener_db import (BLOBS_DIR, CODEC_EXTERNAL, decode_blob, external_blob_path,
+                          fts_enabled)
+from packfile import delete_empty_packs
+from snapshot import settings_path_for, version_output_path
+
+logger = logging.getLogger("Retention")
+
+# Rows deleted per transaction, so snapshots never wait long for gc
+DELETE_BATCH_SIZE = 200
+
+# Pages returned to the file system per incremental_vacuum step
+VACUUM_STEP_PAGES = 2000
+
+# External blob files younger than this may belong to a snapshot that has not
+# committed yet, so they are never treated as orphans
+ORPHAN_GRACE_SECONDS = 3600
+
+# Names write_external_blob creates under BLOBS_DIR: 'xx/<sha1>' and its
+# mkstemp leftovers. Nothing else in that folder is ever deleted.
+EXTERNAL_BLOB_NAME = re.compile(r'([0-9a-f]{2})/\1[0-9a-f]{38}|tmp[a-z0-9_]+\.tmp')
+
+PROJECT_VERSIONS_SQL = '''
+SELECT id, version_number, created_at FROM versions
+WHERE project_id = ?
+ORDER BY version_number DESC
+'''
+
+# Blobs used neither by a stored version nor by a project's stat cache
+UNREFERENCED = '''
+NOT EXISTS (SELECT 1 FROM files f WHERE f.content_hash = b.hash)
+AND NOT EXISTS (SELECT 1 FROM file_stats s WHERE s.content_hash = b.hash)
+'''
+
+UNREFERENCED_BLOBS_SQL = f"SELECT id FROM blobs b WHERE {UNREFERENCED}"
+
+UNREFERENCED_BLOB_ROWS_SQL = (
+    "SELECT id, size, codec, content FROM blobs b "
+    f"WHERE id IN ({{placeholders}}) AND {UNREFERENCED}"
+)
+
+# What a dry run would delete: files of the versions it would prune do not count
+WOULD_BE_UNREFERENCED_SQL = '''
+SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs b
+WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.content_hash = b.hash
+                  AND f.version_id NOT IN (SELECT id FROM temp.pruned_versions))
+AND NOT EXISTS (SELECT 1 FROM file_stats s WHERE s.content_hash = b.hash)
+'''
+
+
+def retention_from_settings(settings: Dict) -> Optional[Dict[str, int]]:
+    """
+    Get the retention policy from the "retention" setting.
+
+    Example: {"retention": {"keep_last": 20, "keep_daily": 7, "keep_weekly": 4}}
+
+    Args:
+        settings: Contents of appsettings.json
+
+    Returns:
+        Policy with keep_last, keep_daily and keep_weekly counts, or None if
+        the setting is missing and every version should be kept
+    """
+    policy = settings.get("retention")
+    if not isinstance(policy, dict):
+        return None
+    return {key: max(0, int(policy.get(key, 0)))
+            for key in ("keep_last", "keep_daily", "keep_weekly")}
+
+
+def select_kept_versions(versions: List[Tuple[int, str]], policy: Dict[str, int]) -> Set[int]:
+    """
+    Apply a retention policy to the versions of a project.
+
+    The latest version is always kept. On top of that the keep_last most
+    recent versions are kept, plus the newest version of each of the
+    keep_daily most recent days and keep_weekly most recent ISO weeks that
+    have versions.
+
+    Args:
+        versions: (version_number, created_at) pairs, newest first
+        policy: Policy from retention_from_settings
+
+    Returns:
+        Version numbers to keep
+    """
+    kept = {number for number, _ in versions[:max(1, policy["keep_last"])]}
+
+    days = {}
+    weeks = {}
+    for number, created_at in versions:
+        created = datetime.fromisoformat(created_at)
+        # Versions are newest first, so the first one seen per period is its newest
+        days.setdefault(created.date(), number)
+        weeks.setdefault(created.isocalendar()[:2], number)
+
+    kept.update(list(days.values())[:policy["keep_daily"]])
+    kept.update(list(weeks.values())[:policy["keep_weekly"]])
+    return kept
+
+
+def _remove_file(path: str) -> None:
+    """Remove a file that may already be gone, logging other failures."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove {path}: {e}")
+
+
+def delete_versions(conn: sqlite3.Connection, version_ids: List[int]) -> None:
+    """
+    Delete versions with their file rows and directory hashes.
+
+    Each batch is its own short transaction.
+
+    Args:
+        conn: Open database connection
+        version_ids: Database IDs of the versions to delete
+    """
+    for i in range(0, len(version_ids), DELETE_BATCH_SIZE):
+        batch = [(version_id,) for version_id in version_ids[i:i + DELETE_BATCH_SIZE]]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM files WHERE version_id = ?", batch)
+            conn.executemany("DELETE FROM trees WHERE version_id = ?", batch)
+            conn.executemany("DELETE FROM versions WHERE id = ?", batch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def prune_project(conn: sqlite3.Connection, project_id: int, project_path: str,
+                  policy: Dict[str, int], dry_run: bool = False) -> List[Tuple[int, int]]:
+    """
+    Delete the versions of a project that its retention policy does not keep.
+
+    The markdown outputs of deleted versions are removed from the project's
+    .dev/versions folder as well.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        project_path: Root folder of the project
+        policy: Policy from retention_from_settings
+        dry_run: Only report what would be deleted
+
+    Returns:
+        (version_id, version_number) pairs of the pruned versions
+    """
+    rows = conn.execute(PROJECT_VERSIONS_SQL, (project_id,)).fetchall()
+    kept = select_kept_versions([(number, created_at) for _, number, created_at in rows], policy)
+    pruned = [(version_id, number) for version_id, number, _ in rows if number not in kept]
+    if dry_run or not pruned:
+        return pruned
+
+    delete_versions(conn, [version_id for version_id, _ in pruned])
+    for _, number in pruned:
+        _remove_file(version_output_path(project_path, number))
+    return pruned
+
+
+def count_unreferenced_blobs(conn: sqlite3.Connection,
+                             pruned_version_ids: List[int]) -> Tuple[int, int]:
+    """
+    Count the stored contents a gc would delete, without deleting anything.
+
+    Args:
+        conn: Open database connection
+        pruned_version_ids: Database IDs of the versions the gc would prune
+
+    Returns:
+        Tuple of the number of blobs and the number of content bytes
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS pruned_versions (id INTEGER PRIMARY KEY)")
+    try:
+        conn.executemany("INSERT OR IGNORE INTO temp.pruned_versions (id) VALUES (?)",
+                         [(version_id,) for version_id in pruned_version_ids])
+        count, total_bytes = conn.execute(WOULD_BE_UNREFERENCED_SQL).fetchone()
+    finally:
+        conn.rollback()
+        conn.execute("DROP TABLE temp.pruned_versions")
+    return count, total_bytes
+
+
+def delete_unreferenced_blobs(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """
+    Delete stored contents that nothing refers to any more.
+
+    Contents are also removed from the full-text index, which needs the
+    original text because the index is contentless. External blobs are not
+    indexed. Their files are removed once their rows are gone, unless a
+    snapshot has rewritten them within ORPHAN_GRACE_SECONDS or stored the
+    same contents again; the orphan sweep takes care of those later.
+
+    Args:
+        conn: Open database connection
+
+    Returns:
+        Tuple of the number of blobs and the number of content bytes
+    """
+    blob_ids = [row[0] for row in conn.execute(UNREFERENCED_BLOBS_SQL)]
+    deleted = 0
+    total_bytes = 0
+    with_fts = fts_enabled(conn)
+    for i in range(0, len(blob_ids), DELETE_BATCH_SIZE):
+        batch = blob_ids[i:i + DELETE_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Checked again under the write lock in case a snapshot reused a blob
+            rows = conn.execute(
+                UNREFERENCED_BLOB_ROWS_SQL.format(placeholders=placeholders), batch).fetchall()
+            deleted += len(rows)
+            total_bytes += sum(row[1] for row in rows)
+            if with_fts:
+                conn.executemany(
+                    "INSERT INTO blob_fts (blob_fts, rowid, content) VALUES ('delete', ?, ?)",
+                    ((blob_id, decode_blob(codec, stored)) for blob_id, _, codec, stored in rows
+                     if codec != CODEC_EXTERNAL))
+            conn.executemany("DELETE FROM blobs WHERE id = ?", ((row[0],) for row in rows))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        # A snapshot writes an external file before it commits its row, so a
+        # recent file may already belong to new contents with the same hash
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for _, _, codec, stored in rows:
+            if codec != CODEC_EXTERNAL:
+                continue
+            path = external_blob_path(stored)
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+            except OSError:
+                continue
+            if conn.execute("SELECT 1 FROM blobs WHERE codec = ? AND content = ?",
+                            (CODEC_EXTERNAL, stored)).fetchone() is None:
+                _remove_file(path)
+    return deleted, total_bytes
+
+
+def delete_orphan_blob_files(conn: sqlite3.Connection, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Delete files in the external blob store that no blob row refers to.
+
+    These are left behind by runs that stopped between writing a large file
+    and committing its row. Files younger than ORPHAN_GRACE_SECONDS are kept,
+    and so is anything whose name write_external_blob would not have made.
+
+    Args:
+        conn: Open database connection
+        dry_run: Only report what would be deleted
+
+    Returns:
+        Tuple of the number of files and their size in bytes
+    """
+    if not os.path.isdir(BLOBS_DIR):
+        return 0, 0
+    referenced = {row[0] for row in conn.execute(
+        "SELECT content FROM blobs WHERE codec = ?", (CODEC_EXTERNAL,))}
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    deleted = 0
+    total_bytes = 0
+    for dirpath, _, filenames in os.walk(BLOBS_DIR):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, BLOBS_DIR).replace(os.sep, '/')
+            if not EXTERNAL_BLOB_NAME.fullmatch(name):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name in referenced or st.st_mtime > cutoff:
+                continue
+            deleted += 1
+            total_bytes += st.st_size
+            if not dry_run:
+                _remove_file(path)
+    return deleted, total_bytes
+
+
+def incremental_vacuum(conn: sqlite3.Connection, step_pages: int = VACUUM_STEP_PAGES,
+                       full_vacuum: bool = False) -> int:
+    """
+    Return free pages to the file system in small steps.
+
+    A database created before incremental auto-vacuum was enabled has to be
+    converted with a full VACUUM, which rewrites the whole file and blocks
+    every other writer while it runs. That only happens when asked for.
+
+    Args:
+        conn: Open database connection with no transaction in progress
+        step_pages: Pages freed per step; each step is a short write transaction
+        full_vacuum: Convert an older database with a one-time full VACUUM
+
+    Returns:
+        Number of pages freed
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if not full_vacuum:
+            logger.warning("Incremental auto-vacuum is not enabled in this database; "
+                           "run 'fltn gc --full-vacuum' once to convert it")
+            return 0
+        logger.info("Enabling incremental auto-vacuum (one-time full VACUUM)")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return 0
+
+    freed = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages == 0:
+            break
+        conn.execute(f"PRAGMA incremental_vacuum({step_pages})").fetchall()
+        freed += min(free_pages, step_pages)
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return freed
+
+
+def collect_garbage(conn: sqlite3.Connection, project_id: Optional[int] = None,
+                    dry_run: bool = False, vacuum: bool = True,
+                    full_vacuum: bool = False) -> Dict:
+    """
+    Apply every project's retention policy and reclaim the space it frees.
+
+    Each project uses the "retention" setting of its own .dev/appsettings.json
+    (or the installed default); projects without one keep every version.
+
+    Args:
+        conn: Open database connection
+        project_id: Only prune this project; unreferenced contents are always
+            collected across the whole database
+        dry_run: Only report what would be deleted
+        vacuum: Return freed pages to the file system afterwards
+        full_vacuum: Allow a one-time full VACUUM to convert an older database
+
+    Returns:
+        Dictionary with pruned versions per project name, deleted blobs,
+        their size in bytes, deleted orphaned blob files and freed pages
+    """
+    query = "SELECT id, name, path FROM projects"
+    projects = conn.execute(
+        query + " WHERE id = ?" if project_id is not None else query,
+        (project_id,) if project_id is not None else ()).fetchall()
+
+    pruned = {}
+    pruned_version_ids = []
+    for pid, name, path in projects:
+        policy = retention_from_settings(load_settings(settings_path_for(path)))
+        if policy is None:
+            continue
+        versions = prune_project(conn, pid, path, policy, dry_run)
+        if versions:
+            numbers = [number for _, number in versions]
+            pruned[name] = numbers
+            pruned_version_ids.extend(version_id for version_id, _ in versions)
+            logger.info(f"{'Would prune' if dry_run else 'Pruned'} {len(numbers)} versions of {name}")
+
+    if not dry_run:
+        packs = delete_empty_packs(conn)
+        if packs:
+            logger.info(f"Deleted {packs} packs whose versions were all pruned")
+
+    if dry_run:
+        blobs, blob_bytes = count_unreferenced_blobs(conn, pruned_version_ids)
+    else:
+        blobs, blob_bytes = delete_unreferenced_blobs(conn)
+    logger.info(f"{'Would delete' if dry_run else 'Deleted'} {blobs} unreferenced contents "
+                f"({blob_bytes} bytes)")
+    orphans, orphan_bytes = delete_orphan_blob_files(conn, dry_run)
+    if orphans:
+        logger.info(f"{'Would delete' if dry_run else 'Deleted'} {orphans} orphaned blob files "
+                    f"({orphan_bytes} bytes)")
+
+    freed_pages = 0
+    if vacuum and not dry_run:
+        freed_pages = incremental_vacuum(conn, full_vacuum=full_vacuum)
+    return {"pruned": pruned, "blobs": blobs, "blob_bytes": blob_bytes,
+            "orphan_files": orphans, "freed_pages": freed_pages}
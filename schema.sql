@@ -1,4 +1,8 @@
 -- Schema for CodeFlattener VCS
+-- Tracked with PRAGMA user_version, see flattener_db.py for migrations
+PRAGMA user_version = 11;
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- Projects table
 CREATE TABLE
     IF NOT EXISTS projects (
@@ -15,10 +19,58 @@ CREATE TABLE
         project_id INTEGER NOT NULL,
         version_number INTEGER NOT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        -- Merkle hash of the version's file tree, equal for identical snapshots
+        tree_hash TEXT,
+        -- Set when the version's files live in a pack archive instead of the files table
+        pack_id INTEGER REFERENCES packs (id),
+        -- Commit the version was imported from by `fltn import-git`
+        git_commit TEXT,
         FOREIGN KEY (project_id) REFERENCES projects (id),
         UNIQUE (project_id, version_number)
     );
 
+-- Pack archives of cold versions under ~/.fltn_data/<project>/
+CREATE TABLE
+    IF NOT EXISTS packs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        first_version INTEGER NOT NULL,
+        last_version INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (project_id) REFERENCES projects (id)
+    );
+
+-- Last allocated version number of each project, bumped atomically
+CREATE TABLE
+    IF NOT EXISTS project_heads (
+        project_id INTEGER PRIMARY KEY,
+        last_version INTEGER NOT NULL,
+        FOREIGN KEY (project_id) REFERENCES projects (id)
+    );
+
+-- Hash of every directory of a version, so diffs can skip unchanged subtrees
+CREATE TABLE
+    IF NOT EXISTS trees (
+        version_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        parent_path TEXT,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (version_id, path),
+        FOREIGN KEY (version_id) REFERENCES versions (id)
+    ) WITHOUT ROWID;
+
+-- Content-addressed file contents, shared by every version that uses them
+CREATE TABLE
+    IF NOT EXISTS blobs (
+        id INTEGER PRIMARY KEY,
+        hash TEXT NOT NULL UNIQUE,
+        size INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        -- 0 = UTF-8 text, 1 = zlib-compressed UTF-8
+        codec INTEGER NOT NULL DEFAULT 0
+    );
+
 -- Files table
 CREATE TABLE
     IF NOT EXISTS files (
@@ -26,8 +78,71 @@ CREATE TABLE
         version_id INTEGER NOT NULL,
         rel_path TEXT NOT NULL,
         filename TEXT NOT NULL,
-        content TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
         language TEXT,
+        -- Encoding the file was decoded from; NULL means UTF-8
+        encoding TEXT,
         FOREIGN KEY (version_id) REFERENCES versions (id),
+        FOREIGN KEY (content_hash) REFERENCES blobs (hash),
         UNIQUE (version_id, rel_path, filename)
     );
+
+-- Stat cache used by the flattener to skip re-reading unchanged files
+CREATE TABLE
+    IF NOT EXISTS file_stats (
+        project_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        content_hash TEXT NOT NULL,
+        encoding TEXT,
+        PRIMARY KEY (project_id, path),
+        FOREIGN KEY (project_id) REFERENCES projects (id),
+        FOREIGN KEY (content_hash) REFERENCES blobs (hash)
+    );
+
+-- AI docs table
+CREATE TABLE
+    IF NOT EXISTS ai_docs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        doc_number INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (project_id) REFERENCES projects (id)
+    );
+
+CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (content_hash);
+
+CREATE INDEX IF NOT EXISTS idx_files_path ON files (rel_path, filename, version_id);
+
+CREATE INDEX IF NOT EXISTS idx_ai_docs_project ON ai_docs (project_id, doc_number);
+
+CREATE INDEX IF NOT EXISTS idx_file_stats_content_hash ON file_stats (content_hash);
+
+CREATE INDEX IF NOT EXISTS idx_versions_pack ON versions (pack_id);
+
+CREATE INDEX IF NOT EXISTS idx_trees_parent ON trees (version_id, parent_path);
+
+CREATE INDEX IF NOT EXISTS idx_projects_name ON projects (name);
+
+-- Full-text index over blob contents; rowid is blobs.id and the text is
+-- inserted by the writers because blobs may be compressed
+CREATE VIRTUAL TABLE IF NOT EXISTS blob_fts USING fts5 (content, content = '');
+
+-- Full-text index over AI docs, kept in sync by triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS ai_docs_fts USING fts5 (content, content = 'ai_docs', content_rowid = 'id');
+
+CREATE TRIGGER IF NOT EXISTS ai_docs_fts_insert AFTER INSERT ON ai_docs BEGIN
+    INSERT INTO ai_docs_fts (rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ai_docs_fts_delete AFTER DELETE ON ai_docs BEGIN
+    INSERT INTO ai_docs_fts (ai_docs_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ai_docs_fts_update AFTER UPDATE ON ai_docs BEGIN
+    INSERT INTO ai_docs_fts (ai_docs_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO ai_docs_fts (rowid, content) VALUES (new.id, new.content);
+END;
@@ -0,0 +1,152 @@
+import re
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+from flattener_db import decode_blob, fts_enabled
+
+logger = logging.getLogger("Search")
+
+DEFAULT_LIMIT = 20
+
+# Longest snippet line shown for a hit
+SNIPPET_WIDTH = 160
+
+# Words with a special meaning in FTS5 queries, not search terms
+FTS_OPERATORS = {"AND", "OR", "NOT", "NEAR"}
+
+SEARCH_FILES_SQL = '''
+WITH hits AS (
+    SELECT rowid AS blob_id, rank FROM blob_fts WHERE blob_fts MATCH :query
+),
+ranked AS (
+    SELECT p.name AS project_name, MAX(v.version_number) AS version_number,
+           f.rel_path, f.filename, hits.blob_id, MIN(hits.rank) AS best_rank
+    FROM hits
+    JOIN blobs b ON b.id = hits.blob_id
+    JOIN files f ON f.content_hash = b.hash
+    JOIN versions v ON v.id = f.version_id
+    JOIN projects p ON p.id = v.project_id
+    WHERE (:project IS NULL OR p.name = :project OR p.path = :project)
+      AND (:version IS NULL OR v.version_number = :version)
+    GROUP BY p.id, f.rel_path, f.filename, hits.blob_id
+    ORDER BY best_rank
+    LIMIT :limit
+)
+-- Contents are only fetched for the hits that made the limit
+SELECT ranked.project_name, ranked.version_number, ranked.rel_path, ranked.filename,
+       b.codec, b.content, ranked.best_rank
+FROM ranked
+JOIN blobs b ON b.id = ranked.blob_id
+ORDER BY ranked.best_rank
+'''
+
+SEARCH_DOCS_SQL = '''
+SELECT p.name, d.doc_number, d.created_at,
+       snippet(ai_docs_fts, 0, '[', ']', '...', 16) AS snippet
+FROM ai_docs_fts
+JOIN ai_docs d ON d.id = ai_docs_fts.rowid
+JOIN projects p ON p.id = d.project_id
+WHERE ai_docs_fts MATCH :query
+  AND (:project IS NULL OR p.name = :project OR p.path = :project)
+ORDER BY ai_docs_fts.rank
+LIMIT :limit
+'''
+
+
+def query_terms(query: str) -> List[str]:
+    """
+    Extract the plain search terms from an FTS5 query.
+
+    Args:
+        query: FTS5 query string
+
+    Returns:
+        Lower-cased terms, without operators and column filters
+    """
+    words = re.findall(r'\w+', query)
+    return [w.lower() for w in words if w not in FTS_OPERATORS]
+
+
+def make_snippet(content: str, terms: List[str], max_lines: int = 3) -> str:
+    """
+    Build a snippet of the lines of a file that contain the search terms.
+
+    Args:
+        content: File contents
+        terms: Lower-cased search terms
+        max_lines: Maximum number of matching lines to include
+
+    Returns:
+        Matching lines prefixed with their line numbers
+    """
+    lines = []
+    for number, line in enumerate(content.splitlines(), start=1):
+        lowered = line.lower()
+        if any(term in lowered for term in terms):
+            lines.append(f"{number}: {line.strip()[:SNIPPET_WIDTH]}")
+            if len(lines) >= max_lines:
+                break
+    return "\n".join(lines)
+
+
+def search_files(conn: sqlite3.Connection, query: str, project: Optional[str] = None,
+                 version: Optional[int] = None, limit: int = DEFAULT_LIMIT) -> List[Dict]:
+    """
+    Full-text search over stored file contents.
+
+    Each distinct (project, path, content) is reported once, with the most
+    recent version that contains it.
+
+    Args:
+        conn: Open database connection
+        query: FTS5 query string
+        project: Project name or path to restrict the search to
+        version: Version number to restrict the search to
+        limit: Maximum number of hits
+
+    Returns:
+        List of hits with project, version, path, rank and snippet
+    """
+    if not fts_enabled(conn):
+        raise RuntimeError("Full-text search is not available in this database")
+
+    terms = query_terms(query)
+    rows = conn.execute(SEARCH_FILES_SQL, {
+        "query": query, "project": project, "version": version, "limit": limit})
+
+    hits = []
+    for name, version_number, rel_path, filename, codec, stored, rank in rows:
+        content = decode_blob(codec, stored)
+        hits.append({
+            'project': name,
+            'version': version_number,
+            'path': f"{rel_path}/{filename}" if rel_path else filename,
+            'rank': rank,
+            'snippet': make_snippet(content, terms)
+        })
+    return hits
+
+
+def search_docs(conn: sqlite3.Connection, query: str, project: Optional[str] = None,
+                limit: int = DEFAULT_LIMIT) -> List[Dict]:
+    """
+    Full-text search over the stored AI docs.
+
+    Args:
+        conn: Open database connection
+        query: FTS5 query string
+        project: Project name or path to restrict the search to
+        limit: Maximum number of hits
+
+    Returns:
+        List of hits with project, doc number, creation time and snippet
+    """
+    if not fts_enabled(conn):
+        raise RuntimeError("Full-text search is not available in this database")
+
+    rows = conn.execute(SEARCH_DOCS_SQL, {
+        "query": query, "project": project, "limit": limit})
+    return [{'project': name, 'doc_number': doc_number,
+             'created_at': created_at, 'snippet': snippet}
+            for name, doc_number, created_at, snippet in rows]
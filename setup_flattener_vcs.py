@@ -5,11 +5,13 @@ import shutil
 import logging
 import sqlite3
 import datetime
-import re
 import platform
 import requests
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Iterator, Optional
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+from flattener_db import DB_PATH, get_connection
+from flattener_db import register_project as register_project_path
+from parse_flattened import iter_flattened_entries
 
 # Configure base directories
 USER_HOME = os.path.expanduser("~")
@@ -47,66 +49,10 @@ except Exception as e:
     logger.warning(f"Templates directory not found: {e}")
     env = None
 
-# SQLite database setup
-DB_PATH = os.path.join(DATABASE_DIR, "flattener.db")
-
-
 def init_database() -> None:
-    """Initialize the SQLite database with necessary tables."""
+    """Open the shared database connection, creating or upgrading the schema."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Create projects table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS projects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            path TEXT NOT NULL UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-
-        # Create versions table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS versions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id INTEGER NOT NULL,
-            version_number INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (project_id) REFERENCES projects (id),
-            UNIQUE (project_id, version_number)
-        )
-        ''')
-
-        # Create files table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            version_id INTEGER NOT NULL,
-            rel_path TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            content TEXT NOT NULL,
-            language TEXT,
-            FOREIGN KEY (version_id) REFERENCES versions (id),
-            UNIQUE (version_id, rel_path, filename)
-        )
-        ''')
-
-        # Create AI docs table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ai_docs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id INTEGER NOT NULL,
-            doc_number INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (project_id) REFERENCES projects (id)
-        )
-        ''')
-
-        conn.commit()
-        conn.close()
+        get_connection()
         logger.info("Database initialized successfully")
     except sqlite3.Error as e:
         logger.error(f"Database initialization error: {e}")
@@ -124,119 +70,30 @@ def register_project(project_path: str) -> int:
         project_id: Database ID of the project
     """
     try:
-        project_name = os.path.basename(project_path)
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Check if project exists
-        cursor.execute("SELECT id FROM projects WHERE path = ?",
-                       (project_path,))
-        result = cursor.fetchone()
-
-        if result:
-            project_id = result[0]
-            logger.info(
-                f"Found existing project: {project_name} (ID: {project_id})")
-        else:
-            cursor.execute(
-                "INSERT INTO projects (name, path) VALUES (?, ?)",
-                (project_name, project_path)
-            )
-            project_id = cursor.lastrowid
-            logger.info(
-                f"Registered new project: {project_name} (ID: {project_id})")
-
-        conn.commit()
-        conn.close()
+        project_id = register_project_path(get_connection(), project_path)
+        logger.info(
+            f"Using project: {os.path.basename(project_path)} (ID: {project_id})")
         return project_id
     except sqlite3.Error as e:
         logger.error(f"Error registering project: {e}")
         raise
 
 
-def create_version(project_id: int) -> Tuple[int, int]:
-    """
-    Create a new version entry for a project.
-
-    Args:
-        project_id: Database ID of the project
-
-    Returns:
-        Tuple containing version_id and version_number
-    """
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Get the latest version number
-        cursor.execute(
-            "SELECT MAX(version_number) FROM versions WHERE project_id = ?",
-            (project_id,)
-        )
-        result = cursor.fetchone()
-
-        next_version = 1 if result[0] is None else result[0] + 1
-
-        # Create new version
-        cursor.execute(
-            "INSERT INTO versions (project_id, version_number) VALUES (?, ?)",
-            (project_id, next_version)
-        )
-        version_id = cursor.lastrowid
-
-        conn.commit()
-        conn.close()
-
-        logger.info(
-            f"Created version {next_version} for project ID {project_id}")
-        return version_id, next_version
-    except sqlite3.Error as e:
-        logger.error(f"Error creating version: {e}")
-        raise
-
-
-def parse_flattened_file(file_path: str, allowed_extensions: Dict[str, str]) -> List[Dict]:
+def parse_flattened_file(file_path: str, allowed_extensions: Dict[str, str]) -> Iterator[Dict]:
     """
     Parse a flattened markdown file into individual file entries.
 
+    Entries are produced one at a time by the streaming parser in
+    parse_flattened.py, so the whole document is never held in memory.
+
     Args:
         file_path: Path to the flattened markdown file
         allowed_extensions: Dictionary mapping file extensions to language identifiers
 
     Returns:
-        List of dictionaries with file information
+        Iterator of dictionaries with file information
     """
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Parse the markdown file to extract code blocks
-        # Expecting format: # path/to/file.ext\n```language\ncode\n```
-        pattern = r'#\s+(.+?)(?:\n```([a-zA-Z0-9]+)?\n([\s\S]+?)```|$)'
-        matches = re.findall(pattern, content)
-
-        files = []
-        for file_path, language, code in matches:
-            file_path = file_path.strip()
-            rel_path = os.path.dirname(file_path)
-            filename = os.path.basename(file_path)
-
-            # Determine language from file extension if not specified
-            if not language:
-                ext = os.path.splitext(filename)[1]
-                language = allowed_extensions.get(ext, "")
-
-            files.append({
-                'rel_path': rel_path,
-                'filename': filename,
-                'content': code.strip(),
-                'language': language
-            })
-
-        return files
-    except Exception as e:
-        logger.error(f"Error parsing flattened file: {e}")
-        raise
+    return iter_flattened_entries(file_path, allowed_extensions)
 
 
 def check_for_updates() -> Optional[str]:
@@ -271,37 +128,16 @@ def create_template_files() -> None:
 # Generated by setup_flattener_vcs.py
 
 $rootFolder = "{{ root_folder }}"
-$devFolder = "{{ dev_folder }}"
-$projectSaveFolder = "{{ project_save_folder }}"
-$versionsFolder = "{{ versions_folder }}"
-$counterFilePath = "{{ counter_file_path }}"
-$currentVersion = {{ version_number }}
-
-# Create a variable to hold the final path
-$savePath = "{{ output_file_path }}"
 
-# Define the command
-$command = "{{ exe_path }} -i . -o $savePath"
-
-# Try to run the command
-try {
-    Invoke-Expression $command
-}
-catch {
-    Write-Error "Failed to run the command: $command"
+# Store a new version; fltn prints the path of its flattened markdown
+$savePath = python "{{ fltn_path }}" snapshot "$rootFolder"
+if (-not $? -or -not $savePath) {
+    Write-Error "Failed to snapshot the codebase: $rootFolder"
     exit 1
 }
 
-# Run the parser to split the output into the database
-try {
-    python "{{ parser_script_path }}" "$savePath" {{ project_id }} {{ version_id }}
-}
-catch {
-    Write-Error "Failed to parse the output"
-}
-
 # Copy the contents of the current version's text file to the clipboard
-$version_text = Get-Content -Path $savePath
+$version_text = Get-Content -Path $savePath -Raw
 Set-Clipboard -Value $version_text
 
 # Print that the command was executed successfully
@@ -315,29 +151,13 @@ Write-Host "Output version: $savePath"
 # Generated by setup_flattener_vcs.py
 
 ROOT_FOLDER="{{ root_folder }}"
-DEV_FOLDER="{{ dev_folder }}"
-PROJECT_SAVE_FOLDER="{{ project_save_folder }}"
-VERSIONS_FOLDER="{{ versions_folder }}"
-COUNTER_FILE_PATH="{{ counter_file_path }}"
-CURRENT_VERSION={{ version_number }}
-
-# Create a variable to hold the final path
-SAVE_PATH="{{ output_file_path }}"
-
-# Define the command
-COMMAND="{{ exe_path }} -i . -o $SAVE_PATH"
 
-# Try to run the command
-if ! eval $COMMAND; then
-    echo "Failed to run the command: $COMMAND" >&2
+# Store a new version; fltn prints the path of its flattened markdown
+if ! SAVE_PATH=$(python "{{ fltn_path }}" snapshot "$ROOT_FOLDER"); then
+    echo "Failed to snapshot the codebase: $ROOT_FOLDER" >&2
     exit 1
 fi
 
-# Run the parser to split the output into the database
-if ! python "{{ parser_script_path }}" "$SAVE_PATH" {{ project_id }} {{ version_id }}; then
-    echo "Failed to parse the output" >&2
-fi
-
 # Print that the command was executed successfully
 echo "Command executed successfully."
 echo "Output version: $SAVE_PATH"
@@ -430,134 +250,18 @@ def create_parser_script(dev_folder: str) -> str:
     """
     parser_script_path = os.path.join(dev_folder, "parse_flattened.py")
 
-    parser_script_content = '''
-import os
+    # The generated script delegates to the streaming parser in the install
+    # folder, using the appsettings.json copied next to it in .dev
+    parser_script_content = f'''import os
 import sys
-import sqlite3
-import re
-import json
-import logging
-from datetime import datetime
-
-# Configure logging
-DATABASE_DIR = os.path.join(os.path.expanduser("~"), ".fltn_data")
-LOGS_DIR = os.path.join(DATABASE_DIR, "logs")
-os.makedirs(LOGS_DIR, exist_ok=True)
-
-log_file = os.path.join(LOGS_DIR, f"parser_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger("Parser")
 
-def parse_flattened_file(file_path, project_id, version_id):
-    """
-    Parse a flattened markdown file and store in database.
+sys.path.insert(0, {INSTALL_DIR!r})
 
-    Args:
-        file_path: Path to the flattened markdown file
-        project_id: ID of the project in the database
-        version_id: ID of the version in the database
-    """
-    # Load file extensions from appsettings.json
-    appsettings_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "appsettings.json")
-    try:
-        with open(appsettings_path, 'r') as f:
-            settings = json.load(f)
-
-        allowed_extensions = settings.get("allowed_extensions", {})
-    except Exception as e:
-        logger.error(f"Failed to load appsettings.json: {e}")
-        allowed_extensions = {}
-
-    # Read the file
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-    except Exception as e:
-        logger.error(f"Failed to read flattened file: {e}")
-        return
-
-    # Parse the markdown file to extract code blocks
-    pattern = r'#\s+(.+?)(?:\n```([a-zA-Z0-9]+)?\n([\s\S]+?)```|$)'
-    matches = re.findall(pattern, content)
-
-    logger.info(f"Found {len(matches)} file entries in flattened output")
-
-    # Connect to database
-    db_path = os.path.join(DATABASE_DIR, "flattener.db")
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Store each file
-        successful_files = 0
-        for file_path_match, language, code in matches:
-            file_path_clean = file_path_match.strip()
-            rel_path = os.path.dirname(file_path_clean)
-            filename = os.path.basename(file_path_clean)
-
-            # Skip empty or invalid entries
-            if not filename:
-                continue
-
-            # Determine language from file extension if not specified
-            if not language:
-                ext = os.path.splitext(filename)[1]
-                language = allowed_extensions.get(ext, "")
-
-            # Store in database
-            try:
-                cursor.execute(
-                    "INSERT INTO files (version_id, rel_path, filename, content, language) VALUES (?, ?, ?, ?, ?)",
-                    (version_id, rel_path, filename, code.strip(), language)
-                )
-                successful_files += 1
-            except sqlite3.IntegrityError:
-                # Update if already exists
-                cursor.execute(
-                    "UPDATE files SET content = ?, language = ? WHERE version_id = ? AND rel_path = ? AND filename = ?",
-                    (code.strip(), language, version_id, rel_path, filename)
-                )
-                successful_files += 1
-            except Exception as e:
-                logger.error(f"Error storing file {rel_path}/{filename}: {e}")
-
-        conn.commit()
-        conn.close()
-
-        logger.info(f"Successfully processed {successful_files} files from {file_path}")
-    except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
-    except Exception as e:
-        logger.error(f"Failed to process flattened file: {e}")
-
-def main():
-    """Main entry point for the parser script."""
-    if len(sys.argv) < 4:
-        logger.error("Usage: python parse_flattened.py <flattened_file_path> <project_id> <version_id>")
-        sys.exit(1)
-
-    try:
-        flattened_file = sys.argv[1]
-        project_id = int(sys.argv[2])
-        version_id = int(sys.argv[3])
-
-        logger.info(f"Parsing file: {flattened_file}")
-        logger.info(f"Project ID: {project_id}, Version ID: {version_id}")
-
-        parse_flattened_file(flattened_file, project_id, version_id)
-    except Exception as e:
-        logger.error(f"Failed to execute parser: {e}")
-        sys.exit(1)
+import parse_flattened
 
 if __name__ == "__main__":
-    main()
+    parse_flattened.main(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "appsettings.json"))
 '''
 
     with open(parser_script_path, 'w') as f:
@@ -624,22 +328,21 @@ def create_flattener_setup(root_folder: str) -> Tuple[str, str]:
     os.makedirs(ai_docs_folder, exist_ok=True)
     os.makedirs(versions_folder, exist_ok=True)
 
-    # Define source paths for executable and configuration
-    exe_source_path = os.path.join(INSTALL_DIR, 'CodeFlattener.exe')
+    # Define source paths for the snapshot command and configuration
+    fltn_path = os.path.join(INSTALL_DIR, 'fltn.py')
     appsettings_source_path = os.path.join(INSTALL_DIR, 'appsettings.json')
 
     # Verify source files exist
-    if not os.path.isfile(exe_source_path):
-        raise FileNotFoundError(f"Executable not found: {exe_source_path}")
+    if not os.path.isfile(fltn_path):
+        raise FileNotFoundError(
+            f"fltn command not found: {fltn_path}")
     if not os.path.isfile(appsettings_source_path):
         raise FileNotFoundError(
             f"Configuration file not found: {appsettings_source_path}")
 
-    # Copy necessary files to the .dev folder
-    shutil.copy(exe_source_path, dev_folder)
+    # Copy the configuration to the .dev folder
     shutil.copy(appsettings_source_path, dev_folder)
-    logger.info(
-        f"Copied CodeFlattener.exe and appsettings.json to {dev_folder}")
+    logger.info(f"Copied appsettings.json to {dev_folder}")
 
     # Initialize database if needed
     init_database()
@@ -647,9 +350,6 @@ def create_flattener_setup(root_folder: str) -> Tuple[str, str]:
     # Register project in database
     project_id = register_project(root_folder)
 
-    # Create initial version
-    version_id, version_number = create_version(project_id)
-
     # Create parser script
     parser_script_path = create_parser_script(dev_folder)
 
@@ -663,7 +363,7 @@ def create_flattener_setup(root_folder: str) -> Tuple[str, str]:
     # Create or update counter file
     if not os.path.exists(counter_file_path):
         with open(counter_file_path, 'w') as f:
-            f.write(str(version_number))
+            f.write("1")
 
     # Determine which script template to use based on OS
     is_windows = platform.system() == "Windows"
@@ -675,10 +375,6 @@ def create_flattener_setup(root_folder: str) -> Tuple[str, str]:
         script_name = f"run_codeflattener_{base_name}.sh"
         template_name = "shell_script.sh.j2"
 
-    output_file_path = os.path.join(
-        versions_folder, f"{base_name}_codebase_v{version_number}.md")
-    exe_path = os.path.join(dev_folder, "CodeFlattener.exe")
-
     # Render script from template
     script_content = render_template(
         template_name,
@@ -687,12 +383,9 @@ def create_flattener_setup(root_folder: str) -> Tuple[str, str]:
         project_save_folder=project_save_folder,
         versions_folder=versions_folder,
         counter_file_path=counter_file_path,
-        version_number=version_number,
-        output_file_path=output_file_path,
-        exe_path=exe_path,
+        fltn_path=fltn_path,
         parser_script_path=parser_script_path,
         project_id=project_id,
-        version_id=version_id,
         db_path=DB_PATH
     )
 
@@ -772,6 +465,13 @@ def main(args: List[str]) -> None:
     Args:
         args: Command-line arguments.
     """
+    # Older fltn aliases point at this script; hand commands over to fltn.py
+    if args and not os.path.isdir(args[0]):
+        import fltn
+        if args[0] in fltn.build_parser().commands:
+            fltn.main(args)
+            return
+
     logger.info(f"CodeFlattener VCS Setup v{VERSION}")
 
     # Check for updates
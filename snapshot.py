@@ -0,0 +1,135 @@
+import os
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from flattener import (DEFAULT_WORKERS, OUTPUT_FRAMED, OUTPUT_MARKDOWN, load_settings,
+                       output_format_from_settings, scan_project, write_flattened)
+from flattener_db import (UPSERT_FILE_SQL, directory_hashes, get_connection, head_version,
+                          insert_version, register_project, store_tree)
+from parse_flattened import is_framed
+
+INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("Snapshot")
+
+
+def settings_path_for(root_folder: str) -> str:
+    """
+    Find the appsettings.json that applies to a project.
+
+    Args:
+        root_folder: Root directory of the project
+
+    Returns:
+        The project's .dev/appsettings.json, or the installed default
+    """
+    project_settings = os.path.join(root_folder, ".dev", "appsettings.json")
+    if os.path.isfile(project_settings):
+        return project_settings
+    return os.path.join(INSTALL_DIR, "appsettings.json")
+
+
+def version_output_path(root_folder: str, version_number: int) -> str:
+    """Path of the flattened markdown of a project version."""
+    base_name = os.path.basename(root_folder)
+    return os.path.join(
+        root_folder, ".dev", "versions", f"{base_name}_codebase_v{version_number}.md")
+
+
+def store_version_files(conn: sqlite3.Connection, project_id: int,
+                        records: List[Dict], hashes: Dict[str, str]) -> Tuple[int, int]:
+    """
+    Create a new version and record which stored contents make it up.
+
+    The version number is allocated in the same BEGIN IMMEDIATE transaction
+    that stores the files, so a failed store never leaves an empty version
+    behind and concurrent snapshots are serialized by the write lock.
+
+    Args:
+        conn: Open database connection
+        project_id: Database ID of the project
+        records: File records from scan_project
+        hashes: Directory hashes of the records
+
+    Returns:
+        Tuple containing version_id and version_number
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version_id, version_number = insert_version(conn, project_id)
+        conn.executemany(UPSERT_FILE_SQL, [
+            (version_id, r['rel_dir'], r['filename'], r['hash'], r['language'], r['encoding'])
+            for r in records
+        ])
+        store_tree(conn, version_id, hashes)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version_id, version_number
+
+
+def take_snapshot(root_folder: str, workers: int = DEFAULT_WORKERS,
+                  conn: Optional[sqlite3.Connection] = None) -> Dict:
+    """
+    Take a snapshot of a project as a new version.
+
+    The project is scanned against its stat cache, so unchanged files are
+    not read. Contents go straight into the database, the version number is
+    allocated only once the scan is done, and the flattened markdown is
+    written from the stored contents.
+
+    Args:
+        root_folder: Root directory of the project
+        workers: Number of reader threads
+        conn: Open database connection (defaults to the shared one)
+
+    Returns:
+        Dictionary with project_id, version_id, version_number, output_path,
+        files, cache_hits, skipped, seconds and unchanged
+    """
+    start = datetime.now()
+    root_folder = os.path.abspath(root_folder)
+    if not os.path.isdir(root_folder):
+        raise NotADirectoryError(f"Not a directory: {root_folder}")
+
+    conn = conn or get_connection()
+    settings = load_settings(settings_path_for(root_folder))
+    project_id = register_project(conn, root_folder)
+
+    records, stats = scan_project(conn, project_id, root_folder, settings, workers)
+    hashes = directory_hashes(
+        (r['rel_dir'], r['filename'], r['hash'], r['language']) for r in records)
+
+    output_format = output_format_from_settings(settings)
+    head = head_version(conn, project_id)
+    unchanged = head is not None and head[2] == hashes[""]
+    if unchanged:
+        version_id, version_number = head[0], head[1]
+        output_path = version_output_path(root_folder, version_number)
+        # The tree is the same, but the output is rewritten if it is missing
+        # or was written in another output_format
+        if not os.path.isfile(output_path) or \
+                (OUTPUT_FRAMED if is_framed(output_path) else OUTPUT_MARKDOWN) != output_format:
+            write_flattened(conn, records, output_path, output_format)
+    else:
+        version_id, version_number = store_version_files(conn, project_id, records, hashes)
+        output_path = version_output_path(root_folder, version_number)
+        write_flattened(conn, records, output_path, output_format)
+
+    elapsed = (datetime.now() - start).total_seconds()
+    base_name = os.path.basename(root_folder)
+    if unchanged:
+        logger.info(
+            f"No changes in {base_name} since v{version_number}; "
+            f"checked {stats['files']} files ({len(stats['skipped'])} skipped) in {elapsed:.2f}s")
+    else:
+        logger.info(
+            f"Snapshot v{version_number} of {base_name}: {stats['files']} files "
+            f"({stats['cache_hits']} unchanged, {len(stats['skipped'])} skipped) in {elapsed:.2f}s")
+    return {"project_id": project_id, "version_id": version_id,
+            "version_number": version_number, "output_path": output_path,
+            "files": stats["files"], "cache_hits": stats["cache_hits"],
+            "skipped": stats["skipped"], "seconds": elapsed, "unchanged": unchanged}